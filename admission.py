@@ -0,0 +1,104 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+admission.py
+
+Admission control for commands.
+Commands are grouped into classes, each allowed a limited number of
+executions in flight. Commands that can't run right away wait in a bounded
+queue ordered by priority, everything beyond that is turned away.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+from bisect import insort
+from collections import Counter
+from itertools import count
+
+from twisted.internet.defer import Deferred, fail, maybeDeferred
+from twisted.python import log
+
+
+class AdmissionRejected(Exception):
+    """Raised for commands that can't be admitted."""
+
+
+class AdmissionController(object):
+    """
+    Limits commands in flight per class and in total.
+
+    classes maps class names to (limit, priority) tuples. Waiting commands
+    with lower priority values are started first, commands of the same
+    priority in the order they arrived. Commands without a class are never
+    limited.
+    """
+
+    def __init__(self, classes, total=8, queuesize=20):
+        """Initialize an idle controller."""
+        self.classes = classes
+        self.total = total
+        self.queuesize = queuesize
+
+        self.inflight = Counter()
+        self.queue = list()
+        self.sequence = count()
+        self.stats = Counter()
+
+    def run(self, cls, func, deadline=None):
+        """
+        Call func once cls has room and return a Deferred with its result.
+        The Deferred fails with AdmissionRejected if the queue is full or the
+        optional deadline passed while waiting.
+        """
+        if cls is None:
+            return maybeDeferred(func)
+
+        if self.available(cls):
+            self.stats["admitted"] += 1
+            return self.start(cls, func)
+
+        if len(self.queue) >= self.queuesize:
+            self.stats["rejected"] += 1
+            log.msg(format="Rejected %(cls)s command, queue is full.",
+                    cls=cls, logKey="admission.rejected")
+            return fail(AdmissionRejected("queue is full"))
+
+        self.stats["queued"] += 1
+        deferred = Deferred()
+        insort(self.queue, (self.classes[cls][1], next(self.sequence), cls,
+                            func, deadline, deferred))
+        return deferred
+
+    def available(self, cls):
+        """Return True if a command of cls may start right now."""
+        return (sum(self.inflight.values()) < self.total and
+                self.inflight[cls] < self.classes[cls][0])
+
+    def start(self, cls, func):
+        """Call func and release its slot once it's done."""
+        self.inflight[cls] += 1
+
+        def done(result):
+            """Free the slot and start waiting commands."""
+            self.inflight[cls] -= 1
+            self.next()
+            return result
+
+        return maybeDeferred(func).addBoth(done)
+
+    def next(self):
+        """Start waiting commands for which there is room now."""
+        for entry in list(self.queue):
+            # commands finishing right away start others recursively
+            if entry not in self.queue:
+                continue
+            priority, _, cls, func, deadline, deferred = entry
+            if deadline is not None and deadline.expired:
+                self.queue.remove(entry)
+                self.stats["expired"] += 1
+                deferred.errback(AdmissionRejected("deadline passed"))
+            elif self.available(cls):
+                self.queue.remove(entry)
+                self.stats["admitted"] += 1
+                self.start(cls, func).chainDeferred(deferred)
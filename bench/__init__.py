@@ -0,0 +1,12 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+bench
+
+Self-contained benchmark and load-test harness for the Commander IRC bot.
+It provides a fake IRC server, stand-ins for the web APIs used by the parsers
+and a generator for seeded databases. Run it with "python -m bench.run".
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
@@ -0,0 +1,123 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+bench/explain.py
+
+Check that the bot's queries are answered using indexes.
+Every query shape is run through EXPLAIN on the database the parsers read
+from, either PostgreSQL at DATABASE_URL or the SQLite replica. The check
+fails if any of them would scan a whole table.
+
+Usage: python -m bench.explain [--create] [--verbose]
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+import re
+import sys
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+
+from indexes import create_indexes
+from ladder import LadderParser
+from leader import LeaderParser
+from tourney import TourneyParser
+
+# plan lines of full table scans
+SEQUENTIAL_SCANS = {"postgresql": re.compile(r"Seq Scan on (\w+)"),
+                    "sqlite": re.compile(r"^SCAN (?:TABLE )?(\w+)"
+                                         r"(?!.*USING (?:COVERING )?INDEX)")}
+
+
+def query_shapes():
+    """
+    Return (name, query, dialects) tuples for all checked queries.
+    Queries are only checked on the given dialects, or on all if None.
+    """
+    ladder, leader, tourney = LadderParser(), LeaderParser(), TourneyParser()
+    now = datetime.utcnow()
+    treshold = now - timedelta(28)
+    return [("ladder top", ladder.topQuery(28), None),
+            ("active players", ladder.activeQuery(treshold), None),
+            ("rank", ladder.activeQuery(treshold, 0.0), None),
+            # SQLite can't use an index for substring matches
+            ("player names", ladder.playersQuery([u"Player1", u"Player2"]),
+             ("postgresql",)),
+            ("leaderboard", leader.topQuery("uber"), None),
+            ("next tourney", tourney.nearestQuery(False, now, True), None),
+            ("last tourney", tourney.nearestQuery(True, now, False), None)]
+
+
+def explain(query):
+    """Return the plan of a query as a list of lines."""
+    connection = query.session.connection()
+    dialect = connection.dialect
+    compiled = query.statement.compile(dialect=dialect)
+    if compiled.positional:
+        params = [compiled.params[name] for name in compiled.positiontup]
+    else:
+        params = compiled.params
+
+    cursor = connection.connection.cursor()
+    try:
+        if dialect.name == "postgresql":
+            # only fall back to a scan if there is no usable index at all
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute("EXPLAIN " + unicode(compiled), params)
+            return [row[0] for row in cursor.fetchall()]
+        cursor.execute("EXPLAIN QUERY PLAN " + unicode(compiled), params)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+        query.session.rollback()
+
+
+def check(verbose=False):
+    """Explain all query shapes and return the names of failed ones."""
+    failed = list()
+    for name, query, dialects in query_shapes():
+        dialect = query.session.connection().dialect.name
+        if dialects and dialect not in dialects:
+            print "{0:<16} skipped on {1}".format(name, dialect)
+            continue
+
+        plan = explain(query)
+        scans = [match.group(1) for match in
+                 (SEQUENTIAL_SCANS[dialect].search(line) for line in plan)
+                 if match]
+        if scans:
+            failed.append(name)
+            print "{0:<16} FAILED, scans {1}".format(name, ", ".join(scans))
+        else:
+            print "{0:<16} ok".format(name)
+
+        if verbose or scans:
+            for line in plan:
+                print "    {0}".format(line)
+
+    return failed
+
+
+def main(argv):
+    """Run the check and exit with an error if any query fails."""
+    parser = ArgumentParser(description="Check query plans for table scans.")
+    parser.add_argument("--create", action="store_true",
+                        help="create missing indexes first")
+    parser.add_argument("--verbose", action="store_true",
+                        help="print all plans")
+    options = parser.parse_args(argv)
+
+    if options.create:
+        session = LadderParser().session
+        create_indexes(session.get_bind())
+        session.close()
+
+    failed = check(options.verbose)
+    if failed:
+        sys.exit("{0} queries scan whole tables.".format(len(failed)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,160 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+bench/fakes.py
+
+In-process stand-ins for the IRC server and the web APIs used by the bot.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+from datetime import datetime, timedelta
+from json import dumps
+from time import time
+
+from twisted.internet import protocol
+from twisted.internet.defer import Deferred
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.web import resource
+
+from twitter import CREATED_AT_FORMAT
+
+
+class FakeIRCProtocol(LineOnlyReceiver):
+    """
+    Minimal IRC server connection.
+
+    It welcomes the client, acknowledges JOINs and reports every PRIVMSG and
+    NOTICE sent by the client to the factory.
+    """
+
+    delimiter = "\r\n"
+
+    def connectionMade(self):
+        """Register as the factory's client."""
+        self.nickname = None
+        self.factory.client = self
+
+    def lineReceived(self, line):
+        """Handle a line sent by the bot."""
+        received = time()
+        parts = line.split(" ", 2)
+        command = parts[0].upper()
+
+        if command == "NICK":
+            self.nickname = parts[1]
+            self.sendLine(":fake.irc 001 {0} :Welcome".format(self.nickname))
+            self.sendLine(":fake.irc 376 {0} :End of MOTD".format(
+                self.nickname))
+        elif command == "JOIN":
+            for channel in parts[1].split(","):
+                self.sendLine(":{0}!bot@fake JOIN {1}".format(self.nickname,
+                                                              channel))
+            self.factory.clientJoined(self.nickname)
+        elif command == "PING":
+            self.sendLine("PONG {0}".format(parts[1]))
+        elif command in ("PRIVMSG", "NOTICE") and len(parts) == 3:
+            self.factory.replyReceived(parts[1], parts[2][1:], received)
+
+    def sendCommand(self, nick, target, text):
+        """Send a message from nick to target."""
+        self.sendLine(":{0}!{0}@bench PRIVMSG {1} :{2}".format(
+            nick, target, text.encode("utf-8")))
+
+
+class FakeIRCServerFactory(protocol.ServerFactory):
+    """
+    Factory for the fake IRC server.
+    Replies are passed on to the callback given at construction.
+    """
+
+    protocol = FakeIRCProtocol
+
+    def __init__(self, onReply):
+        """Remember the reply callback."""
+        self.client = None
+        self.onReply = onReply
+        self.joined = Deferred()
+
+    def clientJoined(self, nickname):
+        """Fire the joined Deferred with the client's nickname once."""
+        if not self.joined.called:
+            self.joined.callback(nickname)
+
+    def replyReceived(self, target, text, received):
+        """Pass a reply on to the callback."""
+        self.onReply(target, text, received)
+
+
+class JSONResource(resource.Resource):
+    """Resource returning a fixed JSON document."""
+
+    isLeaf = True
+
+    def __init__(self, document):
+        """Encode the document once."""
+        resource.Resource.__init__(self)
+        self.body = dumps(document)
+
+    def render(self, request):
+        """Return the encoded document."""
+        request.setHeader("Content-Type", "application/json")
+        return self.body
+
+
+class TwitchResource(JSONResource):
+    """Resource returning pages of a fixed stream directory."""
+
+    def __init__(self, streams):
+        """Remember all streams, sorted by viewers like the real API."""
+        JSONResource.__init__(self, None)
+        self.streams = sorted(streams, key=lambda s: s["viewers"],
+                              reverse=True)
+
+    def render(self, request):
+        """Return the page selected by the offset and limit arguments."""
+        offset = int(request.args.get("offset", [0])[0])
+        limit = int(request.args.get("limit", [25])[0])
+        request.setHeader("Content-Type", "application/json")
+        return dumps({"_total": len(self.streams),
+                      "streams": self.streams[offset:offset + limit]})
+
+
+def fake_api(streams=25, tweets=100, news=5):
+    """
+    Return a resource tree standing in for the Twitch, Twitter and Uberent
+    APIs with the given number of streams, tweets and news items.
+    """
+    now = datetime.utcnow()
+
+    twitch = [{"viewers": index * 7 % 500,
+               "channel": {"_id": index,
+                           "display_name": u"Streamer{0}".format(index),
+                           "status": u"Stream #{0}".format(index),
+                           "url": u"http://twitch.tv/s{0}".format(index)}}
+              for index in range(streams)]
+
+    # like real status IDs, newer tweets have higher IDs
+    statuses = {"statuses": [{"id": tweets - index,
+                              "created_at": (now - timedelta(0, index * 60))
+                                            .strftime(CREATED_AT_FORMAT),
+                              "text": u"Tweet number {0} #UberRTS".format(
+                                  index),
+                              "user": {"name": u"User {0}".format(index),
+                                       "screen_name": u"user{0}".format(
+                                           index)}}
+                             for index in range(tweets)]}
+
+    uberent = {"News": [{"Timestamp": (now - timedelta(index))
+                                      .strftime("%Y-%m-%d.%H:%M:%S"),
+                         "Title": u"News item {0}".format(index)}
+                        for index in range(news)]}
+
+    root = resource.Resource()
+    root.putChild("twitch", TwitchResource(twitch))
+    root.putChild("search", JSONResource(statuses))
+    root.putChild("token", JSONResource({"token_type": "bearer",
+                                         "access_token": "bench"}))
+    root.putChild("news", JSONResource(uberent))
+    return root
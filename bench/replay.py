@@ -0,0 +1,247 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+bench/replay.py
+
+Replay recorded traffic through CommanderBot against stand-in parsers that
+answer with the recorded results, and compare replays of different builds.
+
+Usage: python -m bench.replay RECORDING [--speed 1|10|max] [--output FILE]
+       python -m bench.replay --compare BASELINE CANDIDATE
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+import random
+import sys
+
+from argparse import ArgumentParser
+from cPickle import dump, load, HIGHEST_PROTOCOL
+from collections import defaultdict, deque
+from difflib import unified_diff
+from time import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import fail, succeed
+from twisted.internet.task import deferLater
+from twisted.test.proto_helpers import StringTransport
+
+from bench.run import percentile
+from deadline import Deadline
+from recorder import read_records
+
+# commands whose output depends on the clock or on chance
+NONDETERMINISTIC = ("now", "roll", "uptime", "twitch", "tourney")
+
+
+class ReplayParser(object):
+    """
+    Stand-in for a parser answering with recorded results.
+    Results are returned after the recorded duration, scaled by speed. Its
+    caches are empty, so there are no fallback answers.
+    """
+
+    crc32 = 0
+    items = streams = tweets = tuple()
+
+    def __init__(self, name, calls, speed):
+        """Remember recorded calls for this parser."""
+        self.name = name
+        self.calls = calls
+        self.speed = speed
+
+    def __getattr__(self, method):
+        """Return a function answering calls of method."""
+        def replayed(*args):
+            """Return the next recorded result for these arguments."""
+            args = tuple(arg for arg in args if not isinstance(arg, Deadline))
+            results = (self.calls.get((self.name, method, repr(args))) or
+                       self.calls.get((self.name, method)))
+            if not results:
+                return succeed(None)
+
+            duration, result = (results.popleft() if len(results) > 1 else
+                                results[0])
+            if isinstance(result, tuple) and result[:1] == ("error",):
+                answer = lambda: fail(Exception(result[1]))
+            else:
+                answer = lambda: result
+
+            if not self.speed:
+                return succeed(None).addCallback(lambda _: answer())
+            return deferLater(reactor, duration / self.speed, answer)
+
+        return replayed
+
+
+class ReplayCapture(object):
+    """
+    Takes the place of the recorder on the replaying bot.
+    Outbound lines are attributed to the oldest unanswered command addressed
+    to the same target, or to the latest command for that target.
+    """
+
+    def __init__(self):
+        """Initialize an empty capture."""
+        self.commands = list()
+        self.pending = list()
+
+    def inbound(self, user, channel, msg):
+        """Remember a command being handled."""
+        nick = user.split("!")[0]
+        self.commands.append({"index": len(self.commands),
+                              "msg": msg,
+                              "command": msg.split(" ", 1)[0][1:],
+                              "targets": (channel, nick),
+                              "received": time(),
+                              "latency": None,
+                              "lines": list()})
+        self.pending.append(self.commands[-1])
+
+    def outbound(self, line):
+        """Attribute a line to the command it answers."""
+        parts = line.split(" ", 2)
+        if len(parts) != 3 or parts[0] not in ("PRIVMSG", "NOTICE"):
+            return
+
+        target = parts[1]
+        for command in self.pending:
+            if target in command["targets"]:
+                command["latency"] = time() - command["received"]
+                self.pending.remove(command)
+                break
+        else:
+            answered = [c for c in self.commands
+                        if target in c["targets"] and c["latency"] is not None]
+            if not answered:
+                return
+            command = answered[-1]
+        command["lines"].append(line)
+
+
+def load_recording(path, speed):
+    """Return inbound commands and stand-in parsers for a recording."""
+    inbound = list()
+    calls = defaultdict(deque)
+    for record in read_records(path):
+        if record[0] == "in":
+            inbound.append(record[1:])
+        elif record[0] == "call":
+            t, parser, method, args, duration, result = record[1:]
+            calls[(parser, method, repr(args))].append((duration, result))
+            calls[(parser, method)].append((duration, result))
+
+    parsers = set(key[0] for key in calls)
+    return inbound, dict((name, ReplayParser(name, calls, speed))
+                         for name in parsers)
+
+
+def replay(path, speed):
+    """Replay a recording and return the captured commands."""
+    from bot import CommanderBot, CommanderFactory
+
+    inbound, parsers = load_recording(path, speed)
+    for name, attr in vars(CommanderBot).items():
+        if hasattr(attr, "parser_class"):
+            attr.parser = parsers.get(name, ReplayParser(name, {}, speed))
+
+    capture = ReplayCapture()
+    CommanderBot.recorder = capture
+    CommanderBot.warmed_up = True
+
+    factory = CommanderFactory()
+    factory.cmdlimit = 0
+    factory.linerate = None
+    bot = factory.buildProtocol(None)
+    bot.makeConnection(StringTransport())
+
+    random.seed(0)
+    last = 0.0
+    for t, user, channel, msg in inbound:
+        delay = t / speed if speed else 0
+        last = max(last, delay)
+        reactor.callLater(delay, bot.privmsg, user, channel, msg)
+
+    reactor.callLater(last + 5.0, reactor.stop)
+    reactor.run()
+    return capture.commands
+
+
+def summary(commands):
+    """Return per-command latency percentiles as a dict."""
+    latencies = defaultdict(list)
+    for command in commands:
+        if command["latency"] is not None:
+            latencies[command["command"]].append(command["latency"])
+    return dict((name, (len(values),
+                        percentile(sorted(values), 0.5),
+                        percentile(sorted(values), 0.99)))
+                for name, values in latencies.iteritems())
+
+
+def compare(baseline, candidate):
+    """Return a report of output and timing differences as list of lines."""
+    lines = list()
+    for base, cand in zip(baseline, candidate):
+        if base["msg"] != cand["msg"]:
+            lines.append("Replays diverge at command {0}.".format(
+                base["index"]))
+            break
+        if base["command"] in NONDETERMINISTIC:
+            continue
+        diff = list(unified_diff(base["lines"], cand["lines"],
+                                 "baseline", "candidate", lineterm=""))
+        if diff:
+            lines.append("Output of #{0} {1!r} differs:".format(
+                base["index"], base["msg"]))
+            lines.extend(diff)
+
+    lines.append("{0:<10} {1:>7} {2:>10} {3:>10} {4:>10} {5:>10}".format(
+        "command", "count", "p50 base", "p50 cand", "p99 base", "p99 cand"))
+    base_summary, cand_summary = summary(baseline), summary(candidate)
+    for name in sorted(set(base_summary) | set(cand_summary)):
+        count, base50, base99 = base_summary.get(name, (0, 0.0, 0.0))
+        count, cand50, cand99 = cand_summary.get(name, (count, 0.0, 0.0))
+        lines.append("{0:<10} {1:>7} {2:>10.2f} {3:>10.2f} {4:>10.2f} "
+                     "{5:>10.2f}".format(name, count,
+                                         1000 * base50, 1000 * cand50,
+                                         1000 * base99, 1000 * cand99))
+    return lines
+
+
+def main(argv):
+    """Replay a recording or compare two replays."""
+    parser = ArgumentParser(description="Commander IRC bot traffic replay.")
+    parser.add_argument("files", nargs="+", metavar="FILE")
+    parser.add_argument("--speed", default="1",
+                        help="time compression factor or max")
+    parser.add_argument("--output", help="store the replay for --compare")
+    parser.add_argument("--compare", action="store_true",
+                        help="compare two stored replays")
+    options = parser.parse_args(argv)
+
+    if options.compare:
+        if len(options.files) != 2:
+            sys.exit("--compare needs a baseline and a candidate replay.")
+        replays = list()
+        for path in options.files:
+            with open(path, "rb") as stored:
+                replays.append(load(stored))
+        for line in compare(*replays):
+            print line
+        return
+
+    speed = 0 if options.speed == "max" else float(options.speed)
+    commands = replay(options.files[0], speed)
+    for name, (count, p50, p99) in sorted(summary(commands).items()):
+        print "{0:<10} {1:>7} {2:>9.2f} {3:>9.2f}".format(
+            name, count, 1000 * p50, 1000 * p99)
+
+    if options.output:
+        with open(options.output, "wb") as stored:
+            dump(commands, stored, HIGHEST_PROTOCOL)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
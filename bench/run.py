@@ -0,0 +1,287 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+bench/run.py
+
+Load test the Commander IRC bot against a fake IRC server, stand-ins for the
+web APIs and the database configured by DATABASE_URL. It reports per-command
+latency percentiles, throughput and reactor lag.
+
+Usage: python -m bench.run [--seed 1k|100k|1m] [--rate N] [--duration S]
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+import sys
+
+from argparse import ArgumentParser
+from collections import defaultdict
+from random import Random
+from time import time
+
+from sqlalchemy import func
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+from twisted.web.server import Site
+
+import misc
+import twitch
+import twitter
+
+from bench.fakes import FakeIRCServerFactory, fake_api
+from bench.seed import Seeder, player_name
+
+DEFAULT_COMMANDS = ("ladder", "stats", "rank", "forecast", "ratio", "suggest",
+                    "compare", "matchups", "top", "twitch", "twitter", "news",
+                    "tourney", "patch", "now", "roll")
+
+
+def percentile(values, fraction):
+    """Return the given percentile of a sorted list of values."""
+    if not values:
+        return 0.0
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+class LagMonitor(object):
+    """Measure how late the reactor runs a timer scheduled at an interval."""
+
+    def __init__(self, interval=0.01):
+        """Initialize an empty sample list."""
+        self.interval = interval
+        self.samples = list()
+        self.last = None
+        self.loop = LoopingCall(self.tick)
+
+    def start(self):
+        """Start sampling."""
+        self.last = time()
+        self.loop.start(self.interval, False)
+
+    def stop(self):
+        """Stop sampling."""
+        if self.loop.running:
+            self.loop.stop()
+
+    def tick(self):
+        """Record the delay of this call."""
+        now = time()
+        self.samples.append(max(0.0, now - self.last - self.interval))
+        self.last = now
+
+
+class LoadGenerator(object):
+    """
+    Sends commands as private queries from a pool of virtual users.
+
+    Replies to a query are addressed to the user who sent it, which is how
+    replies are matched with commands. A user only sends a new command after
+    the previous one was answered or timed out.
+    """
+
+    def __init__(self, players, options):
+        """Initialize users and statistics."""
+        self.client = None
+        self.botnick = None
+        self.players = players
+        self.commands = options.commands
+        self.rate = options.rate
+        self.timeout = options.timeout
+        self.random = Random(options.random_seed)
+
+        self.idle = ["bench{0}".format(n) for n in range(options.users)]
+        self.pending = dict()
+        self.latencies = defaultdict(list)
+        self.timeouts = defaultdict(int)
+        self.skipped = 0
+        self.sent = 0
+        self.loop = LoopingCall(self.tick)
+
+    def player(self):
+        """Return the name of a random seeded player."""
+        return player_name(self.random.randrange(self.players))
+
+    def arguments(self, command):
+        """Return arguments for a command."""
+        if command in ("stats", "rank", "suggest"):
+            return self.player()
+        elif command in ("forecast", "ratio"):
+            return u"{0} {1}".format(self.player(), self.player())
+        elif command == "compare":
+            return u" ".join(self.player() for _ in range(4))
+        elif command == "twitter":
+            return u"5"
+        elif command == "roll":
+            return u"3d6"
+        return None
+
+    def start(self, client, botnick):
+        """Start sending commands through the server connection."""
+        self.client = client
+        self.botnick = botnick
+        self.started = time()
+        self.loop.start(1.0 / self.rate, True)
+
+    def stop(self):
+        """Stop sending commands."""
+        self.stopped = time()
+        if self.loop.running:
+            self.loop.stop()
+
+    def tick(self):
+        """Expire timed out commands and send the next one."""
+        now = time()
+        for nick, (command, sent) in self.pending.items():
+            if now - sent > self.timeout:
+                self.timeouts[command] += 1
+                del self.pending[nick]
+                self.idle.append(nick)
+
+        if not self.idle:
+            self.skipped += 1
+            return
+
+        nick = self.idle.pop(0)
+        command = self.random.choice(self.commands)
+        args = self.arguments(command)
+        line = u"!{0} {1}".format(command, args) if args else u"!" + command
+
+        self.pending[nick] = (command, time())
+        self.sent += 1
+        self.client.sendCommand(nick, self.botnick, line)
+
+    def onReply(self, target, text, received):
+        """Record the latency of the first reply to a pending command."""
+        if target not in self.pending:
+            return
+        command, sent = self.pending.pop(target)
+        self.latencies[command].append(received - sent)
+        self.idle.append(target)
+
+    def report(self, lag):
+        """Return a report as a list of lines."""
+        elapsed = self.stopped - self.started
+        lines = ["{0:<10} {1:>7} {2:>8} {3:>9} {4:>9} {5:>9}".format(
+                 "command", "count", "timeouts", "p50 ms", "p99 ms", "max ms")]
+        done = 0
+        for command in sorted(set(self.latencies) | set(self.timeouts)):
+            values = sorted(self.latencies[command])
+            done += len(values)
+            lines.append("{0:<10} {1:>7} {2:>8} {3:>9.2f} {4:>9.2f} "
+                         "{5:>9.2f}".format(
+                             command, len(values), self.timeouts[command],
+                             1000 * percentile(values, 0.5),
+                             1000 * percentile(values, 0.99),
+                             1000 * (values[-1] if values else 0.0)))
+
+        samples = sorted(lag.samples)
+        lines.append("")
+        lines.append("sent {0} commands in {1:.1f}s, {2} answered "
+                     "({3:.1f}/s), {4} ticks skipped with all users "
+                     "busy".format(self.sent, elapsed, done,
+                                   done / elapsed, self.skipped))
+        lines.append("reactor lag p50 {0:.2f} ms, p99 {1:.2f} ms, "
+                     "max {2:.2f} ms".format(
+                         1000 * percentile(samples, 0.5),
+                         1000 * percentile(samples, 0.99),
+                         1000 * (samples[-1] if samples else 0.0)))
+        return lines
+
+
+def parse_args(argv):
+    """Parse command line arguments."""
+    parser = ArgumentParser(description="Commander IRC bot load test.")
+    parser.add_argument("--seed", metavar="SCALE",
+                        help="seed the (empty) database first: 1k, 100k, 1m")
+    parser.add_argument("--games-per-player", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=20.0,
+                        help="commands per second")
+    parser.add_argument("--duration", type=float, default=30.0,
+                        help="seconds to send commands for")
+    parser.add_argument("--users", type=int, default=20,
+                        help="number of virtual users")
+    parser.add_argument("--timeout", type=float, default=10.0,
+                        help="seconds to wait for a reply")
+    parser.add_argument("--commands", default=",".join(DEFAULT_COMMANDS),
+                        help="comma separated command mix")
+    parser.add_argument("--streams", type=int, default=25)
+    parser.add_argument("--random-seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true",
+                        help="log to stdout")
+    options = parser.parse_args(argv)
+    options.commands = options.commands.split(",")
+    return options
+
+
+def start_fake_api(streams):
+    """Serve the web API stand-ins and point the parsers at them."""
+    port = reactor.listenTCP(0, Site(fake_api(streams=streams)),
+                             interface="127.0.0.1")
+    base = "http://127.0.0.1:{0}".format(port.getHost().port)
+
+    twitch.TWITCH_URL = base + "/twitch"
+    twitter.TWITTER_OAUTH2_URL = base + "/token"
+    twitter.TWITTER_SEARCH_URL = base + "/search"
+    misc.UBERNET_NEWS_URL = base + "/news"
+    return port
+
+
+def main(argv):
+    """Run the benchmark."""
+    options = parse_args(argv)
+    if options.verbose:
+        log.startLogging(sys.stdout)
+
+    if options.seed:
+        Seeder(options.seed, options.games_per_player).seed()
+
+    # bot modules read configuration on import, so import them late
+    from database import Session
+    from database.models import Player
+    from bot import CommanderFactory
+
+    session = Session()
+    players = session.query(func.count(Player.pid)).scalar()
+    session.close()
+    if not players:
+        sys.exit("The database contains no players, use --seed.")
+
+    start_fake_api(options.streams)
+
+    generator = LoadGenerator(players, options)
+    lag = LagMonitor()
+
+    server = FakeIRCServerFactory(generator.onReply)
+    port = reactor.listenTCP(0, server, interface="127.0.0.1")
+
+    factory = CommanderFactory()
+    factory.channels = ["#bench"]
+    factory.cmdlimit = 0
+    factory.linerate = None
+    factory.nickserv = None
+    factory.servers = [("127.0.0.1", port.getHost().port)]
+    reactor.connectTCP("127.0.0.1", port.getHost().port, factory)
+
+    def joined(botnick):
+        """Start the load once the bot has joined its channel."""
+        lag.start()
+        generator.start(server.client, botnick)
+        reactor.callLater(options.duration, finish)
+
+    def finish():
+        """Stop the load and print the report."""
+        generator.stop()
+        lag.stop()
+        for line in generator.report(lag):
+            print line
+        reactor.stop()
+
+    server.joined.addCallback(joined)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
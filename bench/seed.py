@@ -0,0 +1,195 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+bench/seed.py
+
+Seed the configured database with generated ladder, leaderboard and
+tournament data at a given scale.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+from datetime import datetime, timedelta
+from random import Random
+
+from twisted.python import log
+
+from database import Session
+from database.models import (Player, Game, LeaderBoardEntry, UberAccount,
+                             Tournament, Patch)
+
+SCALES = {"1k": 1000, "100k": 100000, "1m": 1000000}
+LEAGUES = ("Uber", "Platinum", "Gold", "Silver", "Bronze")
+CHUNK_SIZE = 10000
+
+
+def player_name(index):
+    """Return the generated name of the player with the given index."""
+    return u"Player{0}".format(index)
+
+
+class Seeder(object):
+    """
+    Generates rows for all tables the bot reads.
+
+    Only columns the bot relies on get meaningful values. All other columns
+    are filled with random values matching their type, so the generator
+    doesn't depend on the exact schema.
+    """
+
+    def __init__(self, scale, games_per_player=5, seed=0):
+        """Remember scale and initialize the random generator."""
+        self.scale = SCALES.get(str(scale).lower()) or int(scale)
+        self.games = self.scale * games_per_player
+        self.random = Random(seed)
+        self.now = datetime.utcnow()
+
+    def value(self, column, index):
+        """Return a random value for a column without specific meaning."""
+        if column.primary_key:
+            return index + 1
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            return None
+
+        if python_type is datetime:
+            return self.now - timedelta(self.random.uniform(0, 60))
+        elif python_type is bool:
+            return False
+        elif python_type in (int, long):
+            return self.random.randint(0, 1000)
+        elif python_type is float:
+            return self.random.gauss(25.0, 5.0)
+        elif python_type in (str, unicode):
+            return u"bench{0}".format(index)
+        return None
+
+    def rows(self, table, count, overrides):
+        """Generate count rows for table, overrides returns known values."""
+        columns = [c for c in table.columns if not c.foreign_keys]
+        for index in range(count):
+            row = dict((c.key, self.value(c, index)) for c in columns)
+            row.update(overrides(index))
+            yield row
+
+    def insert(self, session, table, rows):
+        """Insert rows in chunks of bulk inserts."""
+        chunk = list()
+        total = 0
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == CHUNK_SIZE:
+                session.execute(table.insert(), chunk)
+                total += len(chunk)
+                chunk = list()
+        if chunk:
+            session.execute(table.insert(), chunk)
+            total += len(chunk)
+        session.commit()
+        log.msg("Seeded {0} rows into {1}.".format(total, table.name))
+
+    def player(self, index):
+        """Return known values for a player."""
+        sigma = self.random.uniform(1.0, 8.0)
+        mu = self.random.gauss(25.0, 5.0)
+        values = {Player.name.key: player_name(index),
+                  Player.rating.key: mu - 3 * sigma,
+                  Player.updated.key:
+                      self.now - timedelta(self.random.uniform(0, 60))}
+        # skill is derived from these if the schema stores them
+        if "mu" in Player.__table__.c:
+            values["mu"] = mu
+        if "sigma" in Player.__table__.c:
+            values["sigma"] = sigma
+        return values
+
+    def seed(self):
+        """Fill all tables, they are expected to be empty."""
+        log.msg("Seeding database with {0} players and {1} games.".format(
+            self.scale, self.games))
+        session = Session()
+        try:
+            self.seed_players(session)
+            self.seed_games(session)
+            self.seed_leaderboard(session)
+            self.seed_tournaments(session)
+            self.seed_patches(session)
+        finally:
+            session.close()
+
+    def seed_players(self, session):
+        """Seed players."""
+        self.insert(session, Player.__table__,
+                    self.rows(Player.__table__, self.scale, self.player))
+
+    def seed_games(self, session):
+        """Seed games and their players."""
+        game_table = Game.__table__
+        game_players = Game.players.property.secondary
+        game_fk = [c for c in game_players.columns
+                   if any(fk.references(game_table) for fk in c.foreign_keys)]
+        player_fk = [c for c in game_players.columns
+                     if any(fk.references(Player.__table__)
+                            for fk in c.foreign_keys)]
+
+        pairs = [self.random.sample(xrange(1, self.scale + 1), 2)
+                 for _ in xrange(self.games)]
+
+        def game(index):
+            """Return known values for a game."""
+            return {Game.wid.expression.key:
+                    self.random.choice(pairs[index] + [None])}
+
+        self.insert(session, game_table,
+                    self.rows(game_table, self.games, game))
+        self.insert(session, game_players,
+                    ({game_fk[0].key: index + 1, player_fk[0].key: pid}
+                     for index, pair in enumerate(pairs) for pid in pair))
+
+    def seed_leaderboard(self, session):
+        """Seed Uber accounts and leaderboard entries for all leagues."""
+        accounts = min(self.scale, 5000)
+        self.insert(session, UberAccount.__table__,
+                    self.rows(UberAccount.__table__, accounts,
+                              lambda index: {
+                                  UberAccount.uid.key: index + 1,
+                                  UberAccount.dname.key: player_name(index)}))
+
+        def entry(index):
+            """Return known values for a leaderboard entry."""
+            return {LeaderBoardEntry.uid.key: index + 1,
+                    LeaderBoardEntry.game.key: u"Titans",
+                    LeaderBoardEntry.league.key: LEAGUES[index % 5],
+                    LeaderBoardEntry.rank.key: index // 5 + 1}
+
+        self.insert(session, LeaderBoardEntry.__table__,
+                    self.rows(LeaderBoardEntry.__table__, accounts, entry))
+
+    def seed_tournaments(self, session):
+        """Seed finished and upcoming tournaments."""
+        def tournament(index):
+            """Return known values for a tournament."""
+            date = self.now + timedelta(index - 50)
+            return {Tournament.title.key: u"Tournament {0}".format(index),
+                    Tournament.date.key: date,
+                    Tournament.mode.key: u"1v1",
+                    Tournament.url.key: u"http://example.com/{0}".format(
+                        index),
+                    Tournament.winner.key:
+                        player_name(index) if date < self.now else None}
+
+        self.insert(session, Tournament.__table__,
+                    self.rows(Tournament.__table__, 100, tournament))
+
+    def seed_patches(self, session):
+        """Seed stable and PTE patches."""
+        def patch(index):
+            """Return known values for a patch."""
+            return {Patch.description.key: (u"Stable", u"PTE")[index],
+                    Patch.build.key: unicode(80000 + index),
+                    Patch.updated.key: self.now}
+
+        self.insert(session, Patch.__table__,
+                    self.rows(Patch.__table__, 2, patch))
@@ -11,8 +11,14 @@ Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
 See the file LICENSE for copying permission.
 """
 
+from collections import Counter
 from datetime import datetime, timedelta
+from fnmatch import fnmatch
+from heapq import nlargest
+from operator import itemgetter
+from os.path import basename
 from random import randint, choice
+from time import time
 
 import re
 
@@ -21,16 +27,78 @@ from pytz import timezone, utc
 from twisted.python import log
 from twisted.words.protocols import irc
 from twisted.internet import protocol, reactor
-from twisted.internet.task import LoopingCall
+from twisted.internet.defer import (CancelledError, DeferredList,
+                                    maybeDeferred)
+from twisted.internet.error import TimeoutError
+from twisted.internet.task import LoopingCall, deferLater
 
 import configuration
-from ladder import LadderParser
+import formatting
+from admission import AdmissionController, AdmissionRejected
+from deadline import Deadline
+from ladder import LadderParser, PlayerNotFound
 from leader import LeaderParser
 from twitch import TwitchParser
 from twitter import TwitterParser
 from tourney import TourneyParser
 from patch import PatchParser
 from misc import MiscParser
+from pager import Pager
+
+# number of lines shown in channel and per !more
+PAGE_LINES = 2
+MORE_LINES = 5
+# seconds between warm-up steps
+WARM_UP_SPACING = 0.5
+# most viewed streams listed by !twitch
+MAX_STREAMS = 25
+
+# admission classes as (commands in flight, priority), lower priority first
+COMMAND_CLASSES = {"api": (4, 1),
+                   "ladder": (4, 1),
+                   "heavy": (1, 2)}
+# commands not listed here are cheap and always run right away
+COMMAND_CLASS = {"twitch": "api", "twitter": "api", "news": "api",
+                 "ladder": "ladder", "stats": "ladder", "rank": "ladder",
+                 "forecast": "ladder", "ratio": "ladder", "top": "ladder",
+                 "tourney": "ladder", "patch": "ladder",
+                 "compare": "heavy", "suggest": "heavy", "matchups": "heavy"}
+
+
+class LazyParser(object):
+    """
+    Descriptor for parsers shared by all bot instances.
+    The parser is only created on first access, so importing the bot and
+    connecting to the server don't have to wait for it. Cached state restored
+    from a snapshot before that is applied once the parser is created, then
+    the parser is passed through the optional wrap function.
+    """
+
+    def __init__(self, parser_class):
+        """Remember the parser class to create."""
+        self.parser_class = parser_class
+        self.parser = None
+        self.state = None
+        self.wrap = None
+
+    def __get__(self, instance, owner):
+        """Return the parser, creating it if necessary."""
+        if self.parser is None:
+            started = time()
+            self.parser = self.parser_class()
+            log.msg("Initialized {0} in {1:.3f}s.".format(
+                self.parser_class.__name__, time() - started))
+            if self.state:
+                self.restore(self.parser)
+            if self.wrap:
+                self.parser = self.wrap(self.parser)
+        return self.parser
+
+    def restore(self, parser):
+        """Apply restored state to parser."""
+        for attr, value in self.state.iteritems():
+            setattr(parser, attr, value)
+        self.state = None
 
 
 class TownCrierScheduler(object):
@@ -117,22 +185,79 @@ class CommanderBot(irc.IRCClient):
     # timestamp for flood prevention
     lastcmd = datetime.utcnow()
     started = datetime.utcnow()
-    twitch = TwitchParser()
-    ladder = LadderParser()
-    leader = LeaderParser()
-    tweets = TwitterParser()
-    tourney = TourneyParser()
-    patch = PatchParser()
-    misc = MiscParser()
+    twitch = LazyParser(TwitchParser)
+    ladder = LazyParser(LadderParser)
+    leader = LazyParser(LeaderParser)
+    tweets = LazyParser(TwitterParser)
+    tourney = LazyParser(TourneyParser)
+    patch = LazyParser(PatchParser)
+    misc = LazyParser(MiscParser)
     last_patches = None
+    warmed_up = False
+    recorder = None
+    pager = Pager()
+    hostmask = None
+    command = None
+    deadline = None
+    # number of timed out requests per command
+    timeouts = Counter()
     towncrier = TownCrierScheduler()
 
+    events = None
+
     def sendLine(self, line):
         """Encode all lines as utf-8. Is this a good idea?"""
         if isinstance(line, unicode):
             line = line.encode("utf-8")
+        if self.recorder:
+            self.recorder.outbound(line)
         irc.IRCClient.sendLine(self, line)
 
+    def send_packed(self, command, targets):
+        """
+        Send a command taking several targets, e.g. JOIN or PART, for all
+        targets in as few lines as possible. The server's limit of targets per
+        command is respected.
+        """
+        targets = list(targets)
+        maximum = ((self.supported.getFeature("TARGMAX") or dict())
+                   .get(command) or len(targets) or 1)
+        limit = formatting.MAX_LINE_LENGTH - 2 - len(command) - 1
+        for start in range(0, len(targets), maximum):
+            for line in formatting.pack(targets[start:start + maximum], limit,
+                                        separator=u","):
+                self.sendLine(u"{0} {1}".format(command, line))
+
+    def msg_packed(self, target, items, header=u"", separator=u", "):
+        """
+        Send items to target in as few lines as possible, without exceeding
+        the IRC line length limit.
+        """
+        limit = formatting.available(target,
+                                     self.supported.getFeature("NICKLEN"))
+        for line in formatting.pack(items, limit, header, separator):
+            self.msg(target, line, formatting.MAX_LINE_LENGTH)
+
+    def msg_paged(self, target, nick, items, header=u"", separator=u", "):
+        """
+        Send the first page of items to target. The remaining lines are kept
+        for nick to request with !more.
+        """
+        nicklen = self.supported.getFeature("NICKLEN")
+        # later pages are sent as notices to nick, they must fit as well
+        limit = min(formatting.available(target, nicklen),
+                    formatting.available("n" * nicklen, nicklen, "NOTICE"))
+        lines = formatting.pack(items, limit, header, separator)
+        for line in lines[:PAGE_LINES]:
+            self.msg(target, line, formatting.MAX_LINE_LENGTH)
+
+        self.pager.store(nick, lines[PAGE_LINES:])
+        if len(lines) > PAGE_LINES:
+            self.notice(nick, "There are \x02{0}\x02 more lines, "
+                              "use {1}more to see them.".format(
+                                  len(lines) - PAGE_LINES,
+                                  self.factory.prefix))
+
     def connectionMade(self):
         """
         Upon successful connection establishment, we set up our nickname, real
@@ -143,24 +268,100 @@ class CommanderBot(irc.IRCClient):
         self.lineRate = self.factory.linerate
         irc.IRCClient.connectionMade(self)
 
+    def reconfigure(self, channels):
+        """
+        Apply the factory's current settings to this connection.
+        Joins channels that have been added since channels was configured and
+        leaves those that have been removed.
+        """
+        self.lineRate = self.factory.linerate
+
+        joined = [c for c in self.factory.channels if c not in channels]
+        parted = [c for c in channels if c not in self.factory.channels]
+        if joined or parted:
+            log.msg("Joining channels {0}, leaving channels {1}.".format(
+                joined, parted))
+        self.send_packed("JOIN", joined)
+        self.send_packed("PART", parted)
+
     def signedOn(self):
         """
         Authenticate with NickServ and join the configured channels as soon as
         the welcome message is received.
         """
         irc.IRCClient.signedOn(self)
-        log.msg("Connection established successfully.")
+        log.msg("Connection established successfully after {0}.".format(
+            datetime.utcnow() - self.started))
+        self.factory.resetDelay()
 
         if self.factory.nickserv:
             log.msg("Authenticating with NickServ.")
             self.msg("NickServ", "IDENTIFY {0}".format(self.factory.nickserv))
 
         log.msg("Joining channels {0}.".format(self.factory.channels))
-        for channel in self.factory.channels:
-            self.join(channel)
+        self.send_packed("JOIN", self.factory.channels)
 
-        log.msg("Starting event checker.")
-        LoopingCall(self.check_events).start(120, True)
+        if self.events is None:
+            log.msg("Starting event checker.")
+            self.events = LoopingCall(self.check_events)
+            self.events.start(120, True)
+
+        self.warm_up()
+
+    def connectionLost(self, reason):
+        """Stop checking for events, the next connection starts over."""
+        if self.events and self.events.running:
+            log.msg("Stopping event checker.")
+            self.events.stop()
+        irc.IRCClient.connectionLost(self, reason)
+
+    def warm_up(self):
+        """
+        Initialize parsers and fill their caches.
+        This only happens once, caches stay warm across reconnects. The ladder
+        index is built in a worker thread, all other steps run on the reactor
+        WARM_UP_SPACING seconds apart so commands are served in between.
+        """
+        if CommanderBot.warmed_up:
+            return
+        CommanderBot.warmed_up = True
+
+        def timed(step, name, func):
+            """Run func in its time slot and log how long it took."""
+            deferred = deferLater(reactor, step * WARM_UP_SPACING, time)
+
+            def run(started):
+                """Run func and pass on its start time."""
+                return maybeDeferred(func).addCallback(lambda _: started)
+
+            def done(started):
+                """Log time spent."""
+                log.msg("Warmed up {0} in {1:.3f}s.".format(
+                    name, time() - started))
+
+            def failed(failure):
+                """Log the error, warming up is optional."""
+                log.msg("Warming up {0} failed: {1}".format(
+                    name, failure.getErrorMessage()))
+
+            deferred.addCallback(run)
+            deferred.addCallbacks(done, failed)
+            return deferred
+
+        log.msg("Warming up parsers.")
+        started = time()
+        steps = [("ladder index", lambda: self.ladder.warm_up()),
+                 ("leaderboard", lambda: self.leader.top("uber")),
+                 ("tourney", lambda: self.tourney.next()),
+                 ("patches", lambda: self.patch),
+                 ("news", lambda: self.misc),
+                 ("twitch", lambda: self.twitch.live()),
+                 ("twitter", lambda: self.tweets.startUpdate())]
+        tasks = [timed(step, name, func)
+                 for step, (name, func) in enumerate(steps)]
+        DeferredList(tasks).addCallback(
+            lambda _: log.msg("Warm-up finished in {0:.3f}s.".format(
+                time() - started)))
 
     def privmsg(self, user, channel, msg):
         """Handle messages to either the bot itself or the channel it is in."""
@@ -182,10 +383,13 @@ class CommanderBot(irc.IRCClient):
             return
         self.lastcmd = now
 
+        if self.recorder:
+            self.recorder.inbound(user, channel, msg)
+
         # this might be a bad idea but we assume all data to be utf-8
         msg = msg.decode("utf-8")
-        log.msg(u"Received {0} from {1} on {2}.".format(
-            msg.encode("ascii", "xmlcharrefreplace"), nick, channel))
+        log.msg(format="Received %(cmd)s from %(nick)s on %(channel)s.",
+                cmd=msg, nick=nick, channel=channel, logKey="command")
 
         # command is always separated by a space
         parts = msg.split(" ", 1)
@@ -195,8 +399,78 @@ class CommanderBot(irc.IRCClient):
         # check if we can handle that command
         cmd_name = "handle_command_{0}".format(cmd[1:])
         handle_command = getattr(self, cmd_name, None)
-        if handle_command and callable(handle_command):
-            handle_command(channel, nick, args)
+        if not handle_command or not callable(handle_command):
+            return
+
+        command = cmd[1:]
+        deadline = Deadline(self.factory.budget)
+
+        def execute():
+            """Run the command once it has been admitted."""
+            self.hostmask = user
+            self.command = command
+            self.deadline = deadline
+            return handle_command(channel, nick, args)
+
+        def rejected(failure):
+            """Tell nick to try again later."""
+            failure.trap(AdmissionRejected)
+            log.msg(format="Command %(cmd)s rejected: %(reason)s",
+                    cmd=command, reason=failure.getErrorMessage(),
+                    logKey="command.rejected")
+            self.notice(nick, "Sorry, I'm busy right now. Please try again "
+                              "in a moment.")
+
+        deferred = self.factory.admission.run(COMMAND_CLASS.get(command),
+                                              execute, deadline)
+        deferred.addErrback(rejected)
+        deferred.addErrback(log.err)
+
+    def reply(self, deferred, nick, tell, *args, **kwargs):
+        """
+        Call tell with the result of deferred and args once it fires.
+        If the current command runs out of time or fails, tell is called with
+        the result of the optional fallback keyword argument (a cached answer)
+        instead and nick is told that it may be stale. Without a cached
+        answer, nick is told about the failure. Player names that can't be
+        resolved are answered with suggestions.
+        """
+        fallback = kwargs.get("fallback")
+        command = self.command
+        self.deadline.guard(deferred)
+
+        def failed(failure):
+            """Log the failure and answer from cache if possible."""
+            if failure.check(PlayerNotFound):
+                for name, candidates in failure.value.unresolved:
+                    self.notice(nick, u"No unique match for \x02{0}\x02. "
+                                      u"Did you mean {1}?".format(
+                                          name, u", ".join(candidates)))
+                return
+            elif failure.check(CancelledError, TimeoutError):
+                self.timeouts[command] += 1
+                log.msg(format="Command %(cmd)s timed out.", cmd=command,
+                        logKey="command.timeout")
+                reason = "in time"
+            else:
+                log.msg(format="Command %(cmd)s failed: %(error)s",
+                        cmd=command, error=failure.getErrorMessage(),
+                        logKey="command.error")
+                reason = "right now"
+
+            cached = fallback() if fallback else None
+            if cached is not None:
+                tell(cached, *args)
+                self.notice(nick, "That answer is from cache and may be "
+                                  "outdated.")
+            else:
+                self.notice(nick, "Sorry, I couldn't get an answer "
+                                  "{0}. Please try again later.".format(
+                                      reason))
+
+        deferred.addCallbacks(tell, failed, callbackArgs=args)
+        deferred.addErrback(log.err)
+        return deferred
 
     def handle_command_help(self, channel, nick, args):
         """
@@ -205,10 +479,11 @@ class CommanderBot(irc.IRCClient):
         """
         commands = ("!ladder [activity]", "!stats <user>", "!rank <user>",
                     "!forecast <user1> <user2>", "!ratio <user1> <user2>",
-                    "!suggest <user>",
+                    "!compare <user1> <user2> [...]",
+                    "!suggest <user>", "!matchups [n]",
                     "!top [uber|platinum|gold|silver|bronze]",
-                    "!twitch", "!uptime",
-                    "!twitter [3|5]",
+                    "!twitch [stats]", "!uptime",
+                    "!twitter [3|5|10]", "!more",
                     "!tourney [next|last]",
                     "!patch", "!news",
                     "!exodus",
@@ -242,7 +517,8 @@ class CommanderBot(irc.IRCClient):
         Trigger an update on self.ladder an print topN.
         """
         activity = int(args) if args and args.isdigit() else 28
-        self.ladder.top(activity).addCallback(self.tell_ladder, channel)
+        return self.reply(self.ladder.top(activity), nick, self.tell_ladder,
+                          channel)
 
     def handle_command_stats(self, channel, nick, args):
         """
@@ -255,8 +531,8 @@ class CommanderBot(irc.IRCClient):
             return
 
         userstats = args
-        self.ladder.stats(userstats).addCallback(self.tell_stats,
-                                                 channel, userstats)
+        return self.reply(self.ladder.stats(userstats), nick, self.tell_stats,
+                          channel, userstats)
 
     def handle_command_rank(self, channel, nick, args):
         """
@@ -269,8 +545,8 @@ class CommanderBot(irc.IRCClient):
             return
 
         userrank = args
-        self.ladder.rank(userrank).addCallback(self.tell_rank,
-                                               channel, userrank)
+        return self.reply(self.ladder.rank(userrank), nick, self.tell_rank,
+                          channel, userrank)
 
     def handle_command_forecast(self, channel, nick, args):
         """
@@ -287,8 +563,8 @@ class CommanderBot(irc.IRCClient):
             self.notice(nick, "You need to specify exactly two players.")
             return
 
-        self.ladder.forecast(users[0], users[1]).addCallback(
-            self.tell_forecast, channel, users[0], users[1])
+        return self.reply(self.ladder.forecast(users[0], users[1]), nick,
+                          self.tell_forecast, channel, users[0], users[1])
 
     def handle_command_ratio(self, channel, nick, args):
         """
@@ -305,8 +581,23 @@ class CommanderBot(irc.IRCClient):
             self.notice(nick, "You need to specify exactly two players.")
             return
 
-        self.ladder.ratio(users[0], users[1]).addCallback(
-            self.tell_ratio, channel, users[0], users[1])
+        return self.reply(self.ladder.ratio(users[0], users[1]), nick,
+                          self.tell_ratio, channel, users[0], users[1])
+
+    def handle_command_compare(self, channel, nick, args):
+        """
+        Handle !compare command.
+        It expects (parts of) two or more usernames in args, all of them are
+        looked up in a single query.
+        Trigger an update on self.ladder and print ratings and stats.
+        """
+        users = args.split() if args else list()
+        if len(users) < 2:
+            self.notice(nick, "You need to specify at least two players.")
+            return
+
+        return self.reply(self.ladder.compare(users), nick, self.tell_compare,
+                          channel)
 
     def handle_command_suggest(self, channel, nick, args):
         """
@@ -320,8 +611,21 @@ class CommanderBot(irc.IRCClient):
 
         usersuggest = args
 
-        self.ladder.suggest(usersuggest, 5).addCallback(
-            self.tell_suggestion, channel, usersuggest)
+        return self.reply(self.ladder.suggest(usersuggest, 5), nick,
+                          self.tell_suggestion, channel, usersuggest)
+
+    def handle_command_matchups(self, channel, nick, args):
+        """
+        Handle !matchups command.
+        It expects the number of pairs to print in args (defaults to 5).
+        Trigger an update on self.ladder and print the best pairings.
+        """
+        n = min(int(args), 10) if args and args.isdigit() else 5
+        if n < 1:
+            return
+
+        return self.reply(self.ladder.matchup(n), nick, self.tell_matchups,
+                          channel)
 
     def handle_command_top(self, channel, nick, args):
         """
@@ -336,14 +640,42 @@ class CommanderBot(irc.IRCClient):
         if args and args[0] in initial_dict:
             league = initial_dict[args[0]]
 
-        self.leader.top(league).addCallback(self.tell_top, channel, league)
+        return self.reply(self.leader.top(league), nick, self.tell_top,
+                          channel, nick, league)
+
+    def handle_command_more(self, channel, nick, args):
+        """
+        Handle !more command.
+        Send the next lines of the last long result to nick by notice.
+        """
+        lines = self.pager.next(nick, MORE_LINES)
+        if not lines:
+            self.notice(nick, "There is nothing more to show.")
+            return
+
+        for line in lines:
+            self.notice(nick, line)
+
+        remaining = self.pager.remaining(nick)
+        if remaining:
+            self.notice(nick, "There are \x02{0}\x02 more lines, "
+                              "use {1}more to see them.".format(
+                                  remaining, self.factory.prefix))
 
     def handle_command_twitch(self, channel, nick, args):
         """
         Handle !twitch command.
-        Trigger an update on self.twitch and print current streams.
+        Trigger an update on self.twitch and print current streams, or print
+        aggregate statistics if args is "stats".
         """
-        self.twitch.live().addCallback(self.tell_streams, channel)
+        if args == "stats":
+            self.tell_twitch_stats(self.twitch.statistics(), channel)
+            return
+
+        return self.reply(self.twitch.live(self.deadline), nick,
+                          self.tell_streams, channel, nick,
+                          fallback=lambda: (self.twitch.streams
+                                            if self.twitch.crc32 else None))
 
     def handle_command_twitter(self, channel, nick, args):
         """
@@ -352,7 +684,9 @@ class CommanderBot(irc.IRCClient):
         Trigger an update on self.twitter and print up to N tweets.
         """
         n = int(args) if args and args in ("3", "5", "10") else 1
-        self.tweets.latest(n).addCallback(self.tell_tweets, channel)
+        return self.reply(self.tweets.latest(n, self.deadline), nick,
+                          self.tell_tweets, channel, nick,
+                          fallback=lambda: self.tweets.tweets[0:n] or None)
 
     def handle_command_tourney(self, channel, nick, args):
         """
@@ -361,11 +695,11 @@ class CommanderBot(irc.IRCClient):
         Trigger an update on self.tourney and print next/last tournament.
         """
         if (not args or args == "next" or args not in ("next", "last")):
-            self.tourney.next().addCallback(self.tell_tourney,
-                                            "next", channel)
+            return self.reply(self.tourney.next(), nick, self.tell_tourney,
+                              "next", channel)
         else:
-            self.tourney.last().addCallback(self.tell_tourney,
-                                            "last", channel)
+            return self.reply(self.tourney.last(), nick, self.tell_tourney,
+                              "last", channel)
 
     def handle_command_patch(self, channel, nick, args):
         """
@@ -373,7 +707,7 @@ class CommanderBot(irc.IRCClient):
         It doesn't take any arguments.
         Trigger an update on self.patch and print stable/PTE build ID.
         """
-        self.patch.patches().addCallback(self.tell_patch, channel)
+        return self.reply(self.patch.patches(), nick, self.tell_patch, channel)
 
     def handle_command_news(self, channel, nick, args):
         """
@@ -381,7 +715,9 @@ class CommanderBot(irc.IRCClient):
         It doesn't take any arguments.
         Trigger an update on self.misc and print most recent news item.
         """
-        self.misc.news(1).addCallback(self.tell_news, channel)
+        return self.reply(self.misc.news(1, self.deadline), nick,
+                          self.tell_news, channel,
+                          fallback=lambda: self.misc.items[0:1] or None)
 
     def handle_command_now(self, channel, nick, args):
         """
@@ -400,6 +736,60 @@ class CommanderBot(irc.IRCClient):
                           u"\x02{1}\x02 (Ubertime)".format(
                               now.isoformat(" "), ubernow.isoformat(" ")))
 
+    def handle_command_profile(self, channel, nick, args):
+        """
+        Handle !profile command.
+        It expects a mode ("cpu", "sample" or "memory") and optionally the
+        number of seconds to profile (defaults to 30) in args.
+        Only admins may use it, everyone else is ignored.
+        """
+        if not self.is_admin() or not self.factory.profiler:
+            return
+
+        parts = args.split() if args else list()
+        mode = parts[0] if parts else None
+        seconds = (min(int(parts[1]), 600)
+                   if len(parts) > 1 and parts[1].isdigit() else 30)
+
+        profiler = self.factory.profiler
+        if mode == "cpu":
+            deferred = profiler.profile(seconds)
+        elif mode == "sample":
+            deferred = profiler.sample(seconds)
+        elif mode == "memory":
+            deferred = profiler.snapshot()
+        else:
+            self.notice(nick, "Usage: !profile cpu|sample|memory [seconds]")
+            return
+
+        if mode != "memory":
+            self.notice(nick, "Profiling for \x02{0}\x02 seconds.".format(
+                seconds))
+        deferred.addCallbacks(
+            # the path on the server is nobody's business on IRC
+            lambda path: self.notice(nick, "Profile written to {0}.".format(
+                basename(path))),
+            lambda failure: self.notice(nick, "Profiling failed: {0}".format(
+                failure.getErrorMessage())))
+
+    def handle_command_reload(self, channel, nick, args):
+        """
+        Handle !reload command.
+        Reload the configuration and apply changes right away.
+        Only admins may use it, everyone else is ignored.
+        """
+        if not self.is_admin():
+            return
+
+        try:
+            changes = configuration.reload()
+        except configuration.ConfigError as error:
+            self.notice(nick, "Configuration not reloaded: {0}".format(error))
+            return
+
+        self.notice(nick, "Configuration reloaded, changed: {0}.".format(
+            ", ".join(sorted(changes)) or "nothing"))
+
     def handle_command_roll(self, channel, nick, args):
         """
         Handle !roll command.
@@ -444,13 +834,18 @@ class CommanderBot(irc.IRCClient):
                 numerus, ", ".join(rolls_bold),
                 " => {0}".format(total) if count > 1 else ""))
 
+    def is_admin(self):
+        """Return True if the current command was sent by an admin."""
+        return bool(self.hostmask) and any(fnmatch(self.hostmask, admin)
+                                           for admin in self.factory.admins)
+
     def tell_ladder(self, top, channel):
         """Write top n uberskill players to channel."""
         top_n_str = (u"\x02{0}\x02. {1}".format(x + 1, top[x])
                      for x in range(0, len(top)))
 
-        self.msg(channel, u"1on1 Ladder Top \x02{0}\x02: {1}".format(
-                          len(top), ", ".join(top_n_str)))
+        self.msg_packed(channel, top_n_str,
+                        u"1on1 Ladder Top \x02{0}\x02: ".format(len(top)))
 
     def tell_stats(self, stats, channel, user):
         """Write win/loss statistic for a specific user to channel."""
@@ -541,6 +936,15 @@ class CommanderBot(irc.IRCClient):
                           u"Ratio is {3}:{4}.".format(name1, name2,
                                                       nof_games, wins1, wins2))
 
+    def tell_compare(self, players, channel):
+        """Write ratings and win/draw/loss stats of users to channel."""
+        info = (u"\x02{0}\x02 not found".format(name) if rating is None else
+                u"\x02{0}\x02 {1:.2f} ({2[0]}/{2[1]}/{2[2]})".format(
+                    name, rating, wdl)
+                for name, rating, wdl in players)
+
+        self.msg_packed(channel, info, u"1on1 Ladder Comparison (W/D/L): ")
+
     def tell_suggestion(self, result, channel, user):
         """Write a user's most interesting opponents to channel."""
         if not result:
@@ -553,15 +957,27 @@ class CommanderBot(irc.IRCClient):
                           u"\x02{0}\x02: {1}.".format(name,
                                                       ", ".join(best)))
 
-    def tell_top(self, top, channel, league):
-        """Write top10 for the specified league to channel."""
+    def tell_matchups(self, pairs, channel):
+        """Write the most interesting matchups of the ladder to channel."""
+        if not pairs:
+            self.msg(channel, u"1on1 Ladder: Cannot suggest any matchups.")
+            return
+
+        info = (u"\x02{1}\x02 vs \x02{2}\x02 ({0:.0%})".format(*pair)
+                for pair in pairs)
+        self.msg_packed(channel, info,
+                        u"1on1 Ladder: Most interesting matchups: ")
+
+    def tell_top(self, top, channel, nick, league):
+        """Write the leaderboard for the specified league to channel."""
         top_n_str = (u"\x02{0}\x02. {1}".format(x + 1, top[x])
                      for x in range(0, len(top)))
 
-        self.msg(channel, u"1on1 \x02{0}\x02 Leaderboard: {1}".format(
-                          league.capitalize(), ", ".join(top_n_str)))
+        self.msg_paged(channel, nick, top_n_str,
+                       u"1on1 \x02{0}\x02 Leaderboard: ".format(
+                           league.capitalize()))
 
-    def tell_streams(self, streams, channel):
+    def tell_streams(self, streams, channel, nick):
         """Write streams to channel."""
         if not len(streams):
             self.msg(channel, u"There are no Planetary Annihilation streams "
@@ -570,40 +986,78 @@ class CommanderBot(irc.IRCClient):
 
         number = len(streams)
         if number > 5:
-            self.msg(channel, u"There are \x02{0}\x02 PA streams on Twitch. "
-                              u"For a full list visit http://www.twitch.tv/"
-                              u"directory/game/Planetary%20Annihilation/. "
-                              u"Five most viewed streams: ".format(number))
-            number = 5
+            header = (u"There are \x02{0}\x02 PA streams on Twitch. "
+                      u"For a full list visit http://www.twitch.tv/"
+                      u"directory/game/Planetary%20Annihilation/. "
+                      u"Most viewed streams: ".format(number))
         elif number > 1:
-            self.msg(channel, u"There are \x02{0}\x02 PA streams "
-                              u"on Twitch:".format(number))
+            header = (u"There are \x02{0}\x02 PA streams "
+                      u"on Twitch: ".format(number))
         else:
-            self.msg(channel, u"There is \x02{0}\x02 PA stream "
-                              u"on Twitch:".format(number))
-
-        for x in range(number):
-            desc = streams[x]["desc"] or "No Description"
-            self.msg(channel, u"Stream #{0}: {1} "
-                              u"by \x02{2}\x02 ({3})".format(
-                                  x + 1,
-                                  desc.replace("\n", ""),
-                                  streams[x]["name"],
-                                  streams[x]["url"]))
-
-    def tell_tweets(self, tweets, channel):
+            header = (u"There is \x02{0}\x02 PA stream "
+                      u"on Twitch: ".format(number))
+
+        top = nlargest(MAX_STREAMS, streams, key=itemgetter("viewers"))
+        items = (u"#{0}: {1} by \x02{2}\x02 ({3})".format(
+                     x + 1,
+                     (stream["desc"] or u"No Description").replace("\n", ""),
+                     stream["name"],
+                     stream["url"])
+                 for x, stream in enumerate(top))
+        self.msg_paged(channel, nick, items, header, u" | ")
+
+    def tell_twitch_stats(self, stats, channel):
+        """Write current and peak Twitch aggregates to channel."""
+        if not stats:
+            self.msg(channel, u"There are no Twitch statistics yet.")
+            return
+
+        peak_viewers = stats["peak_viewers"]
+        peak_streams = stats["peak_streams"]
+        self.msg(channel, u"Twitch: \x02{0}\x02 PA streams with \x02{1}\x02 "
+                          u"viewers. Last 24h peaks: \x02{2}\x02 viewers at "
+                          u"{3} and \x02{4}\x02 streams at {5} (UTC).".format(
+                              stats["streams"], stats["viewers"],
+                              peak_viewers[2],
+                              datetime.utcfromtimestamp(
+                                  peak_viewers[0]).strftime("%H:%M"),
+                              peak_streams[1],
+                              datetime.utcfromtimestamp(
+                                  peak_streams[0]).strftime("%H:%M")))
+
+    def tell_new_streams(self, streams, channels):
+        """Announce streams that just went live to channels."""
+        items = [u"\x02{0}\x02: {1} ({2})".format(
+                     stream["name"],
+                     (stream["desc"] or u"No Description").replace("\n", ""),
+                     stream["url"])
+                 for stream in streams]
+        for channel in channels:
+            self.msg_packed(channel, items, u"Now live on Twitch: ", u" | ")
+
+    def tell_new_tweets(self, tweets, channels):
+        """Announce new Tweets to channels."""
+        items = [u"\x02{0}\x02: » {1} « [{2}]".format(
+                     tweet["name"], tweet["text"].replace("\n", " "),
+                     tweet["date"].isoformat(" "))
+                 for tweet in tweets]
+        for channel in channels:
+            self.msg_packed(channel, items, u"New Tweets: ", u" | ")
+
+    def tell_tweets(self, tweets, channel, nick):
         """Write tweets to channel."""
         if not len(tweets):
             self.msg(channel, "Could not acquire any Tweets for #UberRTS.")
             return
 
-        self.msg(channel, u"\x02{0}\x02 latest Tweets "
-                          u"for #UberRTS:".format(len(tweets)))
-
-        for tweet in tweets:
-            self.msg(channel, u"\x02{0}\x02: » {1} « [{2}]".format(
-                tweet["name"], tweet["text"],
-                tweet["date"].isoformat(" ")))
+        items = (u"\x02{0}\x02: » {1} « [{2}]".format(
+                     tweet["name"], tweet["text"].replace("\n", " "),
+                     tweet["date"].isoformat(" "))
+                 for tweet in tweets)
+        self.msg_paged(channel, nick, items,
+                       u"\x02{0}\x02 latest Tweets for #UberRTS: ".format(
+                           len(tweets)),
+                       u" | ")
 
     def tell_tourney(self, tourney, state, channel):
         """Write tourney to channel."""
@@ -659,7 +1113,7 @@ class CommanderBot(irc.IRCClient):
                 for patch in patches)
 
         full_info = u"Latest patch versions: {0}".format(", ".join(info))
-        if isinstance(channel, list):
+        if isinstance(channel, (list, tuple)):
             for c in channel:
                 self.msg(c, full_info)
         else:
@@ -687,7 +1141,10 @@ class CommanderBot(irc.IRCClient):
                                   u"Use !tourney for details.".format(
                                       self.towncrier.event - now))
 
-        # schedule next update
+        self.schedule_tourney_countdown()
+
+    def schedule_tourney_countdown(self):
+        """Schedule the next tourney countdown announcement, if any."""
         try:
             countdown = next(self.towncrier)
             log.msg(u"Scheduling next tournament announcement in {0}s".format(
@@ -704,6 +1161,9 @@ class CommanderBot(irc.IRCClient):
         """
         # are we already waiting for this one?
         if self.towncrier.event == tournament["date"]:
+            # an event restored from a snapshot has no timer yet
+            if self.towncrier.timer is None:
+                self.schedule_tourney_countdown()
             return
 
         # remember this event
@@ -721,30 +1181,61 @@ class CommanderBot(irc.IRCClient):
         """
         Check for events we need to react on.
         Currently these include new patches and new tournaments.
+        They are skipped while the reactor is overloaded.
         """
+        if self.factory.watchdog and self.factory.watchdog.overloaded:
+            log.msg("Reactor is overloaded, skipping event check.")
+            return
+
+        def failed(failure):
+            """Log the error, the next check will retry."""
+            log.msg("Event check failed: {0}".format(
+                failure.getErrorMessage()))
+
         # we tell everyone about new patches
         self.patch.patches().addCallback(self.tell_patch,
                                          self.factory.channels,
-                                         only_new=True)
+                                         only_new=True).addErrback(failed)
 
         # tournaments are not announced, instead we handle countdowns
-        self.tourney.next().addCallback(self.handle_tourney_countdown)
+        self.tourney.next().addCallback(
+            self.handle_tourney_countdown).addErrback(failed)
 
 
-class CommanderFactory(protocol.ClientFactory):
+class CommanderFactory(protocol.ReconnectingClientFactory):
     """
     Factory for Commander IRC connections.
 
     Reads the configuration, stores relevant settings and passes them to the
-    protocol object in buildProtocol.
+    protocol object in buildProtocol. Lost and failed connections are retried
+    with exponential backoff and jitter. Whenever an attempt didn't get the
+    bot signed on, the next one goes to the next configured server.
     """
 
     instance = None
+    watchdog = None
+    profiler = None
+    # reconnect quickly at first, but never wait longer than five minutes
+    initialDelay = 0.5
+    maxDelay = 300
 
     def __init__(self):
-        """Read configuration from a file or store defaults."""
+        """Read configuration and follow changes to it."""
+        cmd_cfg = configuration.get_config("cmd")
+        self.admission = AdmissionController(COMMAND_CLASSES,
+                                             cmd_cfg["inflight"],
+                                             cmd_cfg["queuesize"])
+        self.configure()
+        configuration.add_observer(self.reconfigure)
+
+        self.server = 0
+        self.resetDelay()
+
+    def configure(self):
+        """Store the current settings."""
         irc_cfg = configuration.get_config("irc")
 
+        self.servers = irc_cfg["servers"]
         self.channels = irc_cfg["channels"]
         self.linerate = irc_cfg["linerate"]
         self.nickname = irc_cfg["nickname"]
@@ -755,6 +1246,39 @@ class CommanderFactory(protocol.ClientFactory):
         cmd_cfg = configuration.get_config("cmd")
         self.prefix = cmd_cfg["prefix"]
         self.cmdlimit = cmd_cfg["cmdlimit"]
+        self.budget = cmd_cfg["budget"]
+        self.admission.total = cmd_cfg["inflight"]
+        self.admission.queuesize = cmd_cfg["queuesize"]
+        self.admins = cmd_cfg["admins"]
+
+        twitch_cfg = configuration.get_config("twitch")
+        self.announce = twitch_cfg["announce"]
+
+        twitter_cfg = configuration.get_config("twitter")
+        self.announce_tweets = twitter_cfg["announce"]
+
+    def reconfigure(self, changes):
+        """
+        Apply changed settings without reconnecting.
+        The server and the nickname only change with the next connection.
+        """
+        channels = self.channels
+        self.configure()
+        # a higher limit leaves room for waiting commands
+        self.admission.next()
+
+        if "irc" in changes:
+            old, new = changes["irc"]
+            for setting in ("servers", "nickname"):
+                if old[setting] != new[setting]:
+                    log.msg("Changed {0} setting takes effect on the next "
+                            "connection.".format(setting))
+            if old["ssl"] != new["ssl"]:
+                log.msg("Changed ssl setting takes effect on the next "
+                        "restart.")
+
+        if self.instance:
+            self.instance.reconfigure(channels)
 
     def buildProtocol(self, address):
         """Build a new CommanderBot instance and remember it."""
@@ -767,14 +1291,47 @@ class CommanderFactory(protocol.ClientFactory):
         """Return a list of created CommanderBots."""
         return self.instance
 
+    def announceStreams(self, streams):
+        """Announce new streams if we are connected."""
+        if self.instance:
+            self.instance.tell_new_streams(streams, self.announce)
+
+    def announceTweets(self, tweets):
+        """Announce new Tweets if we are connected."""
+        if self.instance:
+            self.instance.tell_new_tweets(tweets, self.announce_tweets)
+
+    def selectServer(self, connector, rotate):
+        """Point connector to the current server, or the next one if rotate."""
+        if rotate:
+            self.server += 1
+        connector.host, connector.port = self.servers[self.server %
+                                                      len(self.servers)]
+
     def clientConnectionLost(self, connector, reason):
-        """Reconnect to the server if we got disconnected."""
+        """
+        Reconnect if we got disconnected, to the next server unless the bot
+        has been signed on since the last attempt.
+        """
         log.msg("Disconnected from server: {0}".format(
             reason.getErrorMessage()))
-        connector.connect()
+        self.selectServer(connector, self.retries > 0)
+        protocol.ReconnectingClientFactory.clientConnectionLost(
+            self, connector, reason)
 
     def clientConnectionFailed(self, connector, reason):
-        """Stop the reactor if the connection fails."""
+        """Try the next server if the connection fails."""
         log.msg("Connection to server failed: {0}".format(
             reason.getErrorMessage()))
-        reactor.stop()
+        self.selectServer(connector, True)
+        protocol.ReconnectingClientFactory.clientConnectionFailed(
+            self, connector, reason)
+
+    def retry(self, connector=None):
+        """Reconnect after a delay."""
+        protocol.ReconnectingClientFactory.retry(self, connector)
+        if self.continueTrying:
+            log.msg(format="Reconnecting to %(host)s:%(port)d in "
+                           "%(delay).1fs.",
+                    host=self.connector.host, port=self.connector.port,
+                    delay=self.delay, logKey="irc.reconnect")
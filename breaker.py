@@ -0,0 +1,121 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+breaker.py
+
+Circuit breakers for external APIs.
+Calls to an upstream that keeps failing or responding slowly are rejected
+right away for a while, instead of piling up pending requests.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import fail, maybeDeferred
+from twisted.python import log
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    """Raised for calls rejected by an open circuit breaker."""
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker guarding calls to a single upstream.
+
+    While closed, the outcomes of the last window calls are kept. Calls
+    failing or taking longer than latency seconds count as errors. Once at
+    least minimum outcomes are known and the share of errors reaches
+    threshold, the breaker opens and rejects all calls. After cooldown
+    seconds it is half-open and lets a single trial call through, which
+    either closes or opens it again.
+    """
+
+    def __init__(self, name, threshold=0.5, latency=10.0, window=10,
+                 minimum=4, cooldown=60, clock=reactor):
+        """Initialize a closed breaker."""
+        self.name = name
+        self.threshold = threshold
+        self.latency = latency
+        self.minimum = minimum
+        self.cooldown = cooldown
+        self.clock = clock
+
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=window)
+        self.opened = None
+        self.trial = None
+
+    def allow(self):
+        """Return True if a call may be made right now."""
+        now = self.clock.seconds()
+        if self.state == OPEN:
+            if now - self.opened < self.cooldown:
+                return False
+            self.transition(HALF_OPEN)
+
+        if self.state == HALF_OPEN:
+            # a trial that never finished must not block the breaker
+            if self.trial is not None and now - self.trial < self.cooldown:
+                return False
+            self.trial = now
+
+        return True
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func unless the breaker is open and record the outcome.
+        Return a Deferred failing with CircuitOpenError if the call was
+        rejected.
+        """
+        if not self.allow():
+            return fail(CircuitOpenError("{0} is unavailable".format(
+                self.name)))
+
+        started = self.clock.seconds()
+
+        def succeeded(result):
+            """Record a success, unless it took too long."""
+            self.record(self.clock.seconds() - started <= self.latency)
+            return result
+
+        def failed(failure):
+            """Record an error."""
+            self.record(False)
+            return failure
+
+        deferred = maybeDeferred(func, *args, **kwargs)
+        deferred.addCallbacks(succeeded, failed)
+        return deferred
+
+    def record(self, success):
+        """Record the outcome of a call and change state if necessary."""
+        if self.state == HALF_OPEN:
+            self.trial = None
+            self.transition(CLOSED if success else OPEN)
+            return
+        elif self.state == OPEN:
+            # late outcome of a call made before the breaker opened
+            return
+
+        self.outcomes.append(success)
+        errors = self.outcomes.count(False)
+        if (len(self.outcomes) >= self.minimum and
+                errors >= self.threshold * len(self.outcomes)):
+            self.transition(OPEN)
+
+    def transition(self, state):
+        """Change to state."""
+        log.msg(format="Circuit breaker for %(name)s is now %(state)s.",
+                name=self.name, state=state, logKey="breaker.state")
+        self.state = state
+        self.outcomes.clear()
+        if state == OPEN:
+            self.opened = self.clock.seconds()
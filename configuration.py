@@ -4,60 +4,237 @@
 configuration.py
 
 The Commander IRC bot configuration loader.
-It reads configuratiom from environment variables and provides access to
-component specific dictionaries.
+It reads configuratiom from environment variables and an optional
+configuration file and provides access to component specific dictionaries.
+Every component is parsed and validated once, reload() reads all of them
+again and tells observers what changed.
 
 Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
 See the file LICENSE for copying permission.
 """
 
+from collections import Mapping
 from os import environ
 
+from twisted.python import log
 
-def __get_irc_config():
+COMPONENTS = ("irc", "cmd", "twitch", "twitter", "twisted", "manhole",
+              "ingest", "replica", "watchdog")
+
+# parsed configuration per component and reload observers
+__loaded = dict()
+__observers = list()
+
+
+class ConfigError(Exception):
+    """Raised for missing or invalid configuration values."""
+
+
+class Config(Mapping):
+    """Immutable configuration dictionary of a single component."""
+
+    def __init__(self, values):
+        """Copy values, turning lists into tuples."""
+        self.__values = dict((key, tuple(value) if isinstance(value, list)
+                              else value)
+                             for key, value in values.iteritems())
+
+    def __getitem__(self, key):
+        """Return the value of a setting."""
+        return self.__values[key]
+
+    def __iter__(self):
+        """Iterate over the names of all settings."""
+        return iter(self.__values)
+
+    def __len__(self):
+        """Return the number of settings."""
+        return len(self.__values)
+
+    def __repr__(self):
+        """Return a readable representation."""
+        return "Config({0!r})".format(self.__values)
+
+
+def __check(condition, message):
+    """Raise a ConfigError with message unless condition holds."""
+    if not condition:
+        raise ConfigError(message)
+
+
+def __read_file(path):
+    """Read KEY=VALUE lines from a configuration file into a dictionary."""
+    values = dict()
+    with open(path) as config_file:
+        for number, line in enumerate(config_file, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            key, separator, value = line.partition("=")
+            __check(separator, "{0}:{1}: expected KEY=VALUE".format(path,
+                                                                   number))
+            values[key.strip()] = value.strip()
+    return values
+
+
+def __get_source():
+    """
+    Return all settings: the environment overridden by the configuration
+    file at COMMANDER_CONFIG_FILE, if set.
+    """
+    source = dict(environ)
+    path = environ.get("COMMANDER_CONFIG_FILE")
+    if path:
+        try:
+            source.update(__read_file(path))
+        except IOError as error:
+            raise ConfigError("Cannot read {0}: {1}".format(path,
+                                                            error.strerror))
+    return source
+
+
+def __get_irc_config(source):
     """Get a configuration dictionary for IRC specific settings."""
-    channel_list = environ["COMMANDER_IRC_CHANNELS"]
+    channel_list = source["COMMANDER_IRC_CHANNELS"]
     channels = channel_list.split(";")
+    __check(all(channels), "COMMANDER_IRC_CHANNELS has an empty channel")
+
+    # servers are tried in order, ports default to COMMANDER_IRC_PORT
+    port = int(source["COMMANDER_IRC_PORT"])
+    servers = list()
+    for server in source["COMMANDER_IRC_HOSTNAME"].split(";"):
+        hostname, _, server_port = server.partition(":")
+        server_port = int(server_port) if server_port else port
+        __check(hostname, "COMMANDER_IRC_HOSTNAME has an empty hostname")
+        __check(0 < server_port < 65536,
+                "Port of {0} is out of range".format(hostname))
+        servers.append((hostname, server_port))
+
+    linerate = int(source["COMMANDER_IRC_LINERATE"])
+    __check(linerate >= 0, "COMMANDER_IRC_LINERATE is negative")
 
-    return {"hostname": environ["COMMANDER_IRC_HOSTNAME"],
-            "port": int(environ["COMMANDER_IRC_PORT"]),
-            "ssl": True if "COMMANDER_IRC_SSL" in environ else False,
-            "nickserv": environ.get("COMMANDER_IRC_NICKSERV"),
-            "nickname": environ["COMMANDER_IRC_NICKNAME"],
-            "username": environ["COMMANDER_IRC_USERNAME"],
-            "realname": environ["COMMANDER_IRC_REALNAME"],
-            "linerate": int(environ["COMMANDER_IRC_LINERATE"]),
+    return {"hostname": servers[0][0],
+            "port": servers[0][1],
+            "servers": servers,
+            "ssl": True if "COMMANDER_IRC_SSL" in source else False,
+            "nickserv": source.get("COMMANDER_IRC_NICKSERV"),
+            "nickname": source["COMMANDER_IRC_NICKNAME"],
+            "username": source["COMMANDER_IRC_USERNAME"],
+            "realname": source["COMMANDER_IRC_REALNAME"],
+            "linerate": linerate,
             "channels": channels}
 
 
-def __get_cmd_config():
+def __get_cmd_config(source):
     """Get a configuration dictionary for command handling settings."""
-    return {"prefix": environ.get("COMMANDER_CMD_PREFIX", "!"),
-            "cmdlimit": int(environ["COMMANDER_CMD_CMDLIMIT"])}
+    admins = source.get("COMMANDER_CMD_ADMINS")
+
+    config = {"prefix": source.get("COMMANDER_CMD_PREFIX", "!"),
+              "cmdlimit": int(source["COMMANDER_CMD_CMDLIMIT"]),
+              "budget": float(source.get("COMMANDER_CMD_BUDGET", 10)),
+              "inflight": int(source.get("COMMANDER_CMD_INFLIGHT", 8)),
+              "queuesize": int(source.get("COMMANDER_CMD_QUEUESIZE", 20)),
+              "admins": admins.split(";") if admins else list()}
+
+    __check(config["prefix"], "COMMANDER_CMD_PREFIX is empty")
+    __check(config["cmdlimit"] >= 0, "COMMANDER_CMD_CMDLIMIT is negative")
+    __check(config["budget"] > 0, "COMMANDER_CMD_BUDGET must be positive")
+    __check(config["inflight"] > 0, "COMMANDER_CMD_INFLIGHT must be positive")
+    __check(config["queuesize"] >= 0, "COMMANDER_CMD_QUEUESIZE is negative")
+    return config
+
 
+def __get_twitch_config(source):
+    """Get a configuration dictionary for Twitch stream tracking."""
+    announce = source.get("COMMANDER_TWITCH_ANNOUNCE")
+    interval = int(source.get("COMMANDER_TWITCH_INTERVAL", 120))
+    __check(interval > 0, "COMMANDER_TWITCH_INTERVAL must be positive")
 
-def __get_twitter_config():
+    return {"announce": announce.split(";") if announce else list(),
+            "interval": interval}
+
+
+def __get_twitter_config(source):
     """Get a configuration dictionary for a CommandHandler instance."""
 
-    return {"key": environ["COMMANDER_TWITTER_KEY"],
-            "query": environ["COMMANDER_TWITTER_QUERY"],
-            "secret": environ["COMMANDER_TWITTER_SECRET"]}
+    announce = source.get("COMMANDER_TWITTER_ANNOUNCE")
+    interval = int(source.get("COMMANDER_TWITTER_INTERVAL", 300))
+    __check(interval > 0, "COMMANDER_TWITTER_INTERVAL must be positive")
+
+    return {"key": source["COMMANDER_TWITTER_KEY"],
+            "query": source["COMMANDER_TWITTER_QUERY"],
+            "secret": source["COMMANDER_TWITTER_SECRET"],
+            "announce": announce.split(";") if announce else list(),
+            "interval": interval}
+
+
+def __get_ingest_config(source):
+    """Get a configuration dictionary for game result ingestion settings."""
+    return {"source": source.get("COMMANDER_INGEST_SOURCE"),
+            "batchsize": int(source.get("COMMANDER_INGEST_BATCHSIZE", 100)),
+            "queuesize": int(source.get("COMMANDER_INGEST_QUEUESIZE", 1000))}
+
+
+def __get_replica_config(source):
+    """Get a configuration dictionary for SQLite read replica settings."""
+    return {"path": source.get("COMMANDER_REPLICA_PATH"),
+            "interval": int(source.get("COMMANDER_REPLICA_INTERVAL", 60))}
 
 
-def __get_manhole_config():
+def __get_watchdog_config(source):
+    """Get a configuration dictionary for reactor watchdog settings."""
+    shed = source.get("COMMANDER_WATCHDOG_SHED")
+
+    return {"threshold": float(source.get("COMMANDER_WATCHDOG_THRESHOLD",
+                                          0.5)),
+            "shed": float(shed) if shed else None}
+
+
+def __get_manhole_config(source):
     """Get a configuration dictionary for Twisted manhole settings."""
-    port = environ.get("COMMANDER_MANHOLE_PORT")
+    port = source.get("COMMANDER_MANHOLE_PORT")
 
     return {"port": int(port) if port else port}
 
 
-def __get_twisted_config():
+def __get_twisted_config(source):
     """Get a configuration dictionary for Twisted settings."""
 
-    return {"appname": environ["COMMANDER_TWISTED_APP_NAME"],
-            "logpath": environ["COMMANDER_TWISTED_LOG_PATH"],
-            "logname": environ["COMMANDER_TWISTED_LOG_NAME"],
-            "logrotate": int(environ["COMMANDER_TWISTED_LOG_ROTATE"])}
+    return {"appname": source["COMMANDER_TWISTED_APP_NAME"],
+            "logpath": source["COMMANDER_TWISTED_LOG_PATH"],
+            "logname": source["COMMANDER_TWISTED_LOG_NAME"],
+            "logrotate": int(source["COMMANDER_TWISTED_LOG_ROTATE"]),
+            "recordname": source.get("COMMANDER_TWISTED_RECORD_NAME"),
+            "snapshotname": source.get("COMMANDER_TWISTED_SNAPSHOT_NAME")}
+
+
+def __parse(component, source):
+    """Parse and validate the configuration of a component."""
+    try:
+        if component == "irc":
+            config = __get_irc_config(source)
+        elif component == "cmd":
+            config = __get_cmd_config(source)
+        elif component == "twitch":
+            config = __get_twitch_config(source)
+        elif component == "twitter":
+            config = __get_twitter_config(source)
+        elif component == "twisted":
+            config = __get_twisted_config(source)
+        elif component == "manhole":
+            config = __get_manhole_config(source)
+        elif component == "ingest":
+            config = __get_ingest_config(source)
+        elif component == "replica":
+            config = __get_replica_config(source)
+        elif component == "watchdog":
+            config = __get_watchdog_config(source)
+    except KeyError as error:
+        raise ConfigError("{0} is not set".format(error.args[0]))
+    except ValueError as error:
+        raise ConfigError("Invalid {0} setting: {1}".format(component, error))
+
+    return Config(config)
 
 
 def get_config(component):
@@ -66,20 +243,56 @@ def get_config(component):
     Valid components are:
     - irc
     - cmd
+    - twitch
     - twitter
     - twisted
     - manhole
+    - ingest
+    - replica
+    - watchdog
+    The configuration is read on first use and stays the same until it's
+    reloaded. Raises ConfigError if it's incomplete or invalid.
     """
-    if component == "irc":
-        return __get_irc_config()
-    elif component == "cmd":
-        return __get_cmd_config()
-    elif component == "twitter":
-        return __get_twitter_config()
-    elif component == "twisted":
-        return __get_twisted_config()
-    elif component == "manhole":
-        return __get_manhole_config()
-
     # we don't know that config
-    raise KeyError("No such component: {0}".format(component))
+    if component not in COMPONENTS:
+        raise KeyError("No such component: {0}".format(component))
+
+    if component not in __loaded:
+        __loaded[component] = __parse(component, __get_source())
+    return __loaded[component]
+
+
+def add_observer(observer):
+    """
+    Call observer after every reload with a dictionary mapping the names of
+    changed components to (old, new) configuration tuples.
+    """
+    __observers.append(observer)
+
+
+def reload():
+    """
+    Read the configuration of all components in use again.
+    If all of them are valid, they replace the current configuration and
+    observers are told about changes, which are also returned. Otherwise
+    ConfigError is raised and the current configuration is kept.
+    """
+    source = __get_source()
+    fresh = dict((component, __parse(component, source))
+                 for component in __loaded)
+
+    changes = dict((component, (__loaded[component], config))
+                   for component, config in fresh.iteritems()
+                   if config != __loaded[component])
+    __loaded.update(fresh)
+
+    log.msg(format="Reloaded configuration, changed: %(changed)s",
+            changed=", ".join(sorted(changes)) or "nothing",
+            logKey="config.reload")
+    if changes:
+        for observer in list(__observers):
+            try:
+                observer(changes)
+            except Exception:
+                log.err(None, "Applying configuration changes failed.")
+    return changes
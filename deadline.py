@@ -0,0 +1,63 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+deadline.py
+
+Time budgets for commands.
+A deadline is created for every command and passed down to the requests it
+makes, so nothing waits longer than the command is allowed to take.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+from twisted.internet import reactor
+
+
+class Deadline(object):
+    """Point in time by which a command has to be answered."""
+
+    def __init__(self, budget, clock=reactor):
+        """Start a deadline budget seconds from now."""
+        self.budget = budget
+        self.clock = clock
+        self.expires = clock.seconds() + budget
+
+    @property
+    def expired(self):
+        """Return True if no time is left."""
+        return self.remaining() <= 0
+
+    def remaining(self):
+        """Return the number of seconds left."""
+        return max(0.0, self.expires - self.clock.seconds())
+
+    def guard(self, deferred):
+        """
+        Cancel deferred if it hasn't fired once the deadline passes.
+        Its errback chain is run with a CancelledError in that case.
+        """
+        if deferred.called:
+            return deferred
+
+        call = self.clock.callLater(self.remaining(), deferred.cancel)
+
+        def fired(result):
+            """Stop waiting for the deadline."""
+            if call.active():
+                call.cancel()
+            return result
+
+        deferred.addBoth(fired)
+        return deferred
+
+
+def http_timeout(deadline):
+    """
+    Return the timeout for a request made before deadline.
+    The result can be passed to getPage, 0 means there is no deadline.
+    """
+    if deadline is None:
+        return 0
+    # an expired deadline must not turn into "no timeout"
+    return max(deadline.remaining(), 0.001)
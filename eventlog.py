@@ -0,0 +1,197 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+eventlog.py
+
+Buffered, structured log observer.
+Log events are filtered by per-key rate limits and sampling on the reactor
+thread, then formatted, truncated and written as JSON lines in batches by a
+background thread.
+
+Events can be tagged with a logKey to be rate limited, and should use the
+format argument of log.msg, so formatting only happens in the writer:
+
+    log.msg(format="Received %(count)d items.", count=n, logKey="update")
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+from Queue import Queue, Empty, Full
+from datetime import datetime
+from json import dumps
+from random import random
+from threading import Thread
+from time import time
+
+from twisted.python import log
+
+# nothing (or anyone) needs more than that
+MAX_MESSAGE_LENGTH = 2000
+
+# (rate, period) per event key, None for keys that are never limited
+RATE_LIMITS = {"command": None,
+               "command.error": None,
+               "command.rejected": None,
+               "command.timeout": None,
+               "admission.rejected": None,
+               "breaker.state": None,
+               "config.reload": None,
+               "irc.reconnect": (30, 60.0),
+               "twitch.request": (5, 60.0),
+               "twitter.request": (5, 60.0),
+               "news.request": (5, 60.0)}
+
+# fraction of events kept per event key
+SAMPLING = {"twitch.unchanged": 0.1,
+            "twitter.unchanged": 0.1}
+
+
+class RateLimiter(object):
+    """
+    Token buckets per event key.
+    Every key may pass rate events per period on average, with bursts of up
+    to rate events, unless limits holds a different (rate, period) for it or
+    None to let all of its events pass.
+    """
+
+    def __init__(self, rate=10, period=60.0, limits=None):
+        """Initialize empty buckets."""
+        self.rate = rate
+        self.period = period
+        self.limits = RATE_LIMITS if limits is None else limits
+        self.buckets = dict()
+        self.suppressed = dict()
+
+    def allow(self, key):
+        """Return True if an event with this key may pass."""
+        limit = self.limits.get(key, (self.rate, self.period))
+        if limit is None:
+            return True
+
+        rate, period = limit
+        now = time()
+        tokens, last = self.buckets.get(key, (rate, now))
+        refill = (now - last) * rate / period
+        tokens = min(rate, tokens + refill)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return False
+
+        self.buckets[key] = (tokens - 1, now)
+        return True
+
+    def pop_suppressed(self, key):
+        """Return and reset the number of suppressed events for a key."""
+        return self.suppressed.pop(key, 0)
+
+
+class JSONLogObserver(object):
+    """
+    Log observer writing one JSON object per event.
+
+    emit() only filters and queues events. Formatting and file I/O happen in
+    a background thread which writes and flushes events in batches. When the
+    queue is full events are dropped and counted instead of blocking.
+    """
+
+    def __init__(self, logfile, queuesize=10000, batchsize=500,
+                 interval=1.0, limiter=None, sampling=None):
+        """
+        Initialize the observer.
+        sampling maps event keys to the fraction of events to keep, it
+        defaults to SAMPLING.
+        """
+        self.logfile = logfile
+        self.queue = Queue(queuesize)
+        self.batchsize = batchsize
+        self.interval = interval
+        self.limiter = limiter or RateLimiter()
+        self.sampling = SAMPLING if sampling is None else sampling
+        self.dropped = 0
+        self.writer = None
+
+    def start(self):
+        """Start the writer thread."""
+        self.writer = Thread(target=self.write, name="JSONLogObserver")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def stop(self):
+        """Write all queued events and stop the writer thread."""
+        if self.writer:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+
+    def emit(self, eventDict):
+        """Filter and queue an event."""
+        key = eventDict.get("logKey")
+        if key is not None and not eventDict["isError"]:
+            if random() >= self.sampling.get(key, 1.0):
+                return
+            if not self.limiter.allow(key):
+                return
+            suppressed = self.limiter.pop_suppressed(key)
+            if suppressed:
+                eventDict = dict(eventDict, suppressed=suppressed)
+
+        try:
+            self.queue.put_nowait(eventDict)
+        except Full:
+            self.dropped += 1
+
+    def format(self, eventDict):
+        """Return an event as JSON line."""
+        text = log.textFromEventDict(eventDict) or u""
+        if not isinstance(text, unicode):
+            text = text.decode("utf-8", "replace")
+        if len(text) > MAX_MESSAGE_LENGTH:
+            text = u"{0}... ({1} more characters)".format(
+                text[:MAX_MESSAGE_LENGTH], len(text) - MAX_MESSAGE_LENGTH)
+
+        event = {"time": datetime.utcfromtimestamp(
+                     eventDict["time"]).isoformat(),
+                 "system": eventDict.get("system", "-"),
+                 "message": text}
+        if eventDict["isError"]:
+            event["error"] = True
+        for name in ("logKey", "suppressed"):
+            if name in eventDict:
+                event[name] = eventDict[name]
+        return dumps(event) + "\n"
+
+    def write(self):
+        """Write queued events in batches until stopped."""
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=self.interval)]
+            except Empty:
+                continue
+            while len(batch) < self.batchsize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            if None in batch:
+                running = False
+                batch = batch[:batch.index(None)]
+
+            lines = list()
+            for eventDict in batch:
+                try:
+                    lines.append(self.format(eventDict))
+                except Exception as error:
+                    lines.append(dumps({"message": "Unformattable event: "
+                                                   "{0!r}".format(error),
+                                        "error": True}) + "\n")
+            if self.dropped:
+                lines.append(dumps({"message": "Dropped {0} events.".format(
+                    self.dropped), "error": True}) + "\n")
+                self.dropped = 0
+
+            self.logfile.write("".join(lines))
+            self.logfile.flush()
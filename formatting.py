@@ -0,0 +1,125 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+formatting.py
+
+IRC line length aware message formatting.
+Lengths are measured in UTF-8 encoded bytes including the prefix the server
+adds when relaying a message. Lines are only split between characters and
+never inside IRC formatting codes.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+import re
+
+# maximum length of a line including CR-LF
+MAX_LINE_LENGTH = 512
+# assumed maximum lengths of user and host names in relayed prefixes
+MAX_USER_LENGTH = 10
+MAX_HOST_LENGTH = 63
+
+# bold, color (with optional colors), reset, reverse, italic and underline
+FORMAT_CODES = re.compile(u"\x03(?:\\d{1,2}(?:,\\d{1,2})?)?|"
+                          u"[\x02\x0f\x16\x1d\x1f]")
+
+
+def available(target, nicklen, command="PRIVMSG"):
+    """
+    Return the number of bytes available for the text of a message to
+    target, as relayed to others by the server.
+    """
+    prefix = u":{0}!{1}@{2} {3} {4} :".format(
+        "a" * nicklen, "b" * MAX_USER_LENGTH, "c" * MAX_HOST_LENGTH,
+        command, target)
+    return MAX_LINE_LENGTH - 2 - len(prefix.encode("utf-8"))
+
+
+def encoded_length(text):
+    """Return the length of text encoded as UTF-8."""
+    return len(text.encode("utf-8"))
+
+
+def atoms(text):
+    """Split text into characters and whole formatting codes."""
+    position = 0
+    for match in FORMAT_CODES.finditer(text):
+        for char in text[position:match.start()]:
+            yield char
+        yield match.group()
+        position = match.end()
+    for char in text[position:]:
+        yield char
+
+
+def split(text, limit):
+    """
+    Split text into lines of at most limit bytes.
+    Lines are broken at the last space that fits or, if there is none, at
+    the last character or formatting code that fits.
+    """
+    lines = list()
+    line = list()
+    size = 0
+    space = None
+
+    for atom in atoms(text):
+        atom_size = encoded_length(atom)
+        if atom == u" ":
+            space = len(line)
+        # the rest of a line broken at a space may still be too long
+        while size + atom_size > limit and line:
+            if space is not None:
+                if space:
+                    lines.append(u"".join(line[:space]))
+                line = line[space + 1:]
+            else:
+                lines.append(u"".join(line))
+                line = list()
+            size = sum(encoded_length(a) for a in line)
+            space = None
+        # don't start a line with the space it was broken at
+        if atom == u" " and not line and lines:
+            space = None
+            continue
+
+        line.append(atom)
+        size += atom_size
+
+    if line:
+        lines.append(u"".join(line))
+    return lines
+
+
+def pack(items, limit, header=u"", separator=u", "):
+    """
+    Pack items into as few lines of at most limit bytes as possible.
+    The first line starts with header, items on the same line are joined by
+    separator. Items that don't fit on a line of their own are split.
+    """
+    lines = list()
+    line = header
+    empty = True
+    separator_size = encoded_length(separator)
+
+    for item in items:
+        item_size = encoded_length(item)
+        line_size = encoded_length(line)
+        if empty and line_size + item_size <= limit:
+            line += item
+        elif not empty and line_size + separator_size + item_size <= limit:
+            line += separator + item
+        else:
+            if empty:
+                parts = split(line + item, limit)
+            else:
+                lines.append(line)
+                parts = split(item, limit)
+            lines.extend(parts[:-1])
+            line = parts[-1] if parts else u""
+        empty = False
+
+    if line:
+        lines.append(line)
+    return lines
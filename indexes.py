@@ -0,0 +1,101 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+indexes.py
+
+Indexes for the queries the bot runs.
+They are created on the database at DATABASE_URL by running this module and
+on the SQLite replica when it's opened. PostgreSQL additionally gets a
+trigram index for substring searches on player names and partial indexes for
+upcoming and finished tournaments.
+
+Usage: python indexes.py
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+import sys
+
+from twisted.python import log
+
+from database import Session
+from database.models import (Player, Game, LeaderBoardEntry, UberAccount,
+                             Tournament)
+
+GAME_PLAYERS = Game.players.property.secondary
+
+# indexes for both backends, as (table, columns)
+INDEXES = [(Player.__table__, (Player.updated, Player.rating)),
+           (Player.__table__, (Player.rating,)),
+           (GAME_PLAYERS, tuple(GAME_PLAYERS.columns)),
+           (GAME_PLAYERS, tuple(reversed(list(GAME_PLAYERS.columns)))),
+           (Game.__table__, (Game.wid,)),
+           (LeaderBoardEntry.__table__,
+            (LeaderBoardEntry.game, LeaderBoardEntry.league,
+             LeaderBoardEntry.rank)),
+           (UberAccount.__table__, (UberAccount.uid,)),
+           (Tournament.__table__, (Tournament.date,))]
+
+
+def column_names(columns):
+    """Return the names of columns or mapped column attributes."""
+    return [getattr(column, "expression", column).name for column in columns]
+
+
+def create_statements(dialect):
+    """Yield the statements creating all indexes for dialect."""
+    postgres = dialect.name == "postgresql"
+    # building indexes mustn't lock the tables the bot is reading
+    create = ("CREATE INDEX CONCURRENTLY IF NOT EXISTS" if postgres else
+              "CREATE INDEX IF NOT EXISTS")
+
+    for table, columns in INDEXES:
+        names = column_names(columns)
+        yield "{0} ix_{1}_{2} ON {1} ({3})".format(
+            create, table.name, "_".join(names), ", ".join(names))
+
+    if not postgres:
+        return
+
+    players = Player.__table__.name
+    name = column_names([Player.name])[0]
+    yield "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+    yield "{0} ix_{1}_{2}_trgm ON {1} USING gin ({2} gin_trgm_ops)".format(
+        create, players, name)
+
+    tournaments = Tournament.__table__.name
+    date, winner = column_names([Tournament.date, Tournament.winner])
+    for state, predicate in (("upcoming", "IS NULL"),
+                             ("finished", "IS NOT NULL")):
+        yield ("{0} ix_{1}_{2}_{3} ON {1} ({2}) "
+               "WHERE {4} {5}".format(create, tournaments, date, state,
+                                      winner, predicate))
+
+
+def create_indexes(engine):
+    """Create all missing indexes using engine."""
+    # concurrent index builds can't run inside a transaction
+    connection = engine.connect().execution_options(
+        isolation_level="AUTOCOMMIT")
+    try:
+        for statement in create_statements(engine.dialect):
+            log.msg(format="Creating index: %(statement)s",
+                    statement=statement, logKey="indexes.create")
+            connection.execute(statement)
+    finally:
+        connection.close()
+
+
+def main():
+    """Create all indexes on the database at DATABASE_URL."""
+    log.startLogging(sys.stdout)
+    session = Session()
+    try:
+        create_indexes(session.get_bind())
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
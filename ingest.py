@@ -0,0 +1,388 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+ingest.py
+
+Streaming ingestion of 1on1 ladder game results.
+Results are read from a pluggable source into a bounded queue, written to the
+database in batches and applied to the in-memory ladder structures.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+from collections import deque
+from json import loads
+from os import stat
+from time import time
+from urllib import urlencode
+
+from twisted.application import service
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+from twisted.web.client import getPage
+
+from database import Session
+from database.models import Player, Game
+
+from ladder import GAME_KEY
+
+GAME_TABLE = Game.__table__
+GAME_PLAYERS = Game.players.property.secondary
+
+
+def _foreign_key(table, target):
+    """Return the column of table referencing the target table."""
+    for column in table.columns:
+        if any(fk.references(target) for fk in column.foreign_keys):
+            return column
+    raise KeyError("{0} doesn't reference {1}".format(table, target))
+
+GAME_PLAYERS_GAME = _foreign_key(GAME_PLAYERS, GAME_TABLE)
+GAME_PLAYERS_PLAYER = _foreign_key(GAME_PLAYERS, Player.__table__)
+
+
+def parse_result(data):
+    """
+    Parse a decoded JSON game result.
+    It has to contain the game "key", the "winner" player ID (null for draws)
+    and a list of "players" IDs. Any other member naming a column of the game
+    table is stored as well.
+    """
+    columns = dict((name, value) for name, value in data.iteritems()
+                   if name in GAME_TABLE.c and name != GAME_KEY.key)
+    winner = data.get("winner")
+    return {"key": int(data["key"]),
+            "winner": int(winner) if winner is not None else None,
+            "players": [int(pid) for pid in data["players"]],
+            "columns": columns}
+
+
+class QueueSource(object):
+    """
+    In-process stand-in source.
+    Results are pushed with put() and delivered as soon as there is room.
+    """
+
+    def __init__(self):
+        """Initialize an empty backlog."""
+        self.backlog = deque()
+        self.sink = None
+        self.waiting = False
+
+    def start(self, sink):
+        """Start delivering results to sink."""
+        self.sink = sink
+        self.deliver()
+
+    def stop(self):
+        """Stop delivering results."""
+        self.sink = None
+
+    def put(self, result):
+        """Add a parsed result to the backlog."""
+        self.backlog.append(result)
+        self.deliver()
+
+    def deliver(self):
+        """Offer results until the sink applies backpressure."""
+        while self.sink and self.backlog and not self.waiting:
+            accepted = self.sink.offer(self.backlog.popleft())
+            if not accepted.called:
+                self.waiting = True
+                accepted.addCallback(self.resume)
+
+    def resume(self, _):
+        """Continue delivering after the sink accepted a result."""
+        self.waiting = False
+        self.deliver()
+
+
+class FileTailSource(object):
+    """
+    Follow a file containing one JSON encoded result per line.
+    Reading pauses while the sink applies backpressure.
+    """
+
+    def __init__(self, path, interval=1.0):
+        """Remember the file to follow, starting at its current end."""
+        self.path = path
+        self.interval = interval
+        self.offset = None
+        self.partial = ""
+        self.sink = None
+        self.waiting = False
+        self.poller = LoopingCall(self.poll)
+
+    def start(self, sink):
+        """Start following the file."""
+        self.sink = sink
+        self.poller.start(self.interval, True)
+
+    def stop(self):
+        """Stop following the file."""
+        self.sink = None
+        if self.poller.running:
+            self.poller.stop()
+
+    def poll(self):
+        """Read new lines unless a previous result is still pending."""
+        if self.waiting or not self.sink:
+            return
+
+        try:
+            size = stat(self.path).st_size
+        except OSError:
+            return
+
+        # start at the end and restart after truncation
+        if self.offset is None or size < self.offset:
+            self.offset = size if self.offset is None else 0
+            self.partial = ""
+
+        with open(self.path, "rb") as tail:
+            tail.seek(self.offset)
+            while self.sink and not self.waiting:
+                line = tail.readline()
+                if not line:
+                    break
+                self.offset += len(line)
+                if not line.endswith("\n"):
+                    self.partial += line
+                    continue
+
+                line, self.partial = self.partial + line, ""
+                try:
+                    result = parse_result(loads(line, encoding="utf-8"))
+                except (ValueError, KeyError, TypeError):
+                    log.msg("Skipping malformed result: {0!r}".format(line))
+                    continue
+
+                accepted = self.sink.offer(result)
+                if not accepted.called:
+                    self.waiting = True
+                    accepted.addCallback(self.resume)
+
+    def resume(self, _):
+        """Continue reading after the sink accepted a result."""
+        self.waiting = False
+        self.poll()
+
+
+class HTTPFeedSource(object):
+    """
+    Poll an HTTP feed returning a JSON list of results.
+    The key of the last result received is passed as "since" parameter. The
+    next poll only starts after all results have been accepted.
+    """
+
+    def __init__(self, url, interval=30.0):
+        """Remember the feed URL."""
+        self.url = url
+        self.interval = interval
+        self.since = None
+        self.sink = None
+        self.busy = False
+        self.poller = LoopingCall(self.poll)
+
+    def start(self, sink):
+        """Start polling the feed."""
+        self.sink = sink
+        self.poller.start(self.interval, True)
+
+    def stop(self):
+        """Stop polling the feed."""
+        self.sink = None
+        if self.poller.running:
+            self.poller.stop()
+
+    def poll(self):
+        """Request new results unless the previous ones are still pending."""
+        if self.busy or not self.sink:
+            return
+
+        url = self.url
+        if self.since is not None:
+            url = "{0}{1}{2}".format(url, "&" if "?" in url else "?",
+                                     urlencode({"since": self.since}))
+
+        self.busy = True
+        deferred = getPage(url)
+        deferred.addCallback(self.onUpdate)
+        deferred.addErrback(self.onError)
+        deferred.addBoth(self.done)
+
+    def onUpdate(self, value):
+        """Offer all received results one after another."""
+        results = [parse_result(item)
+                   for item in loads(value, encoding="utf-8")]
+        return self.offer(results)
+
+    def offer(self, results):
+        """Offer results until the sink applies backpressure."""
+        while results and self.sink:
+            result = results.pop(0)
+            self.since = max(self.since, result["key"])
+            accepted = self.sink.offer(result)
+            if not accepted.called:
+                accepted.addCallback(lambda _: self.offer(results))
+                return accepted
+
+    def onError(self, error):
+        """Error callback for polling the feed."""
+        log.err("Encountered an error: {0}".format(error.getErrorMessage()))
+
+    def done(self, _):
+        """Allow the next poll."""
+        self.busy = False
+
+
+def get_source(uri):
+    """Create a source for the given URI (file:, http(s): or queue:)."""
+    if uri.startswith("file:"):
+        path = uri[len("file:"):]
+        return FileTailSource(path[2:] if path.startswith("//") else path)
+    elif uri.startswith(("http:", "https:")):
+        return HTTPFeedSource(uri)
+    elif uri == "queue:":
+        return QueueSource()
+
+    raise ValueError("Unsupported ingestion source: {0}".format(uri))
+
+
+class GameIngester(service.Service):
+    """
+    Service moving game results from a source into the database.
+
+    Results are buffered in a bounded queue. Offering a result to a full
+    queue returns a Deferred that only fires once there is room again, which
+    is how sources are slowed down. Batches are written with bulk inserts in
+    a worker thread so the reactor never waits for the database. Batches that
+    fail to be written go back to the front of the queue and are retried with
+    exponential backoff, up to maxdelay seconds apart.
+    """
+
+    def __init__(self, source, getLadder, queuesize=1000, batchsize=100,
+                 interval=1.0, maxdelay=60.0):
+        """Remember source, ladder and limits."""
+        self.source = source
+        self.getLadder = getLadder
+        self.queuesize = queuesize
+        self.batchsize = batchsize
+        self.interval = interval
+        self.maxdelay = maxdelay
+
+        self.queue = deque()
+        self.waiters = deque()
+        self.writing = False
+        self.flusher = LoopingCall(self.flush)
+        self.ingested = 0
+        self.delay = 0
+        self.resume = 0
+
+    def startService(self):
+        """Start consuming results."""
+        service.Service.startService(self)
+        log.msg("Starting game ingestion.")
+        self.flusher.start(self.interval, False)
+        self.source.start(self)
+
+    def stopService(self):
+        """Stop consuming results."""
+        service.Service.stopService(self)
+        log.msg("Stopping game ingestion.")
+        self.source.stop()
+        if self.flusher.running:
+            self.flusher.stop()
+
+    def offer(self, result):
+        """Queue a result, return a Deferred firing once it was accepted."""
+        self.queue.append(result)
+        if len(self.queue) >= self.batchsize:
+            reactor.callLater(0, self.flush)
+        if len(self.queue) < self.queuesize:
+            return succeed(True)
+
+        waiter = Deferred()
+        self.waiters.append(waiter)
+        return waiter
+
+    def flush(self):
+        """Write the next batch unless a write is in progress."""
+        if self.writing or not self.queue or time() < self.resume:
+            return
+
+        batch = [self.queue.popleft()
+                 for _ in range(min(self.batchsize, len(self.queue)))]
+        while self.waiters and len(self.queue) < self.queuesize:
+            self.waiters.popleft().callback(True)
+
+        self.writing = True
+        deferred = deferToThread(self.write, batch)
+        deferred.addCallback(self.onWritten)
+        deferred.addErrback(self.onError, batch)
+        deferred.addBoth(self.done)
+
+    def write(self, batch):
+        """Insert a batch of games in a single transaction."""
+        session = Session()
+        try:
+            keys = set(result["key"] for result in batch)
+            existing = set(key for key, in
+                           session.query(GAME_KEY)
+                                  .filter(GAME_KEY.in_(keys)))
+
+            games = list()
+            players = list()
+            for result in batch:
+                if result["key"] in existing:
+                    continue
+                existing.add(result["key"])
+
+                game = dict(result["columns"])
+                game[GAME_KEY.key] = result["key"]
+                game[Game.wid.expression.key] = result["winner"]
+                games.append(game)
+                players.extend({GAME_PLAYERS_GAME.key: result["key"],
+                                GAME_PLAYERS_PLAYER.key: pid}
+                               for pid in result["players"])
+
+            if games:
+                session.execute(GAME_TABLE.insert(), games)
+                session.execute(GAME_PLAYERS.insert(), players)
+            session.commit()
+
+            new_keys = set(game[GAME_KEY.key] for game in games)
+            return [result for result in batch if result["key"] in new_keys]
+        finally:
+            session.close()
+
+    def onWritten(self, written):
+        """Apply written games to the in-memory ladder structures."""
+        self.delay = 0
+        # the counters ignore games until they have been built
+        ladder = self.getLadder()
+        for result in sorted(written, key=lambda r: r["key"]):
+            ladder.wdl.add_game(result["key"], result["winner"],
+                                result["players"])
+
+        self.ingested += len(written)
+        log.msg("Ingested {0} new game results.".format(len(written)))
+
+    def onError(self, error, batch):
+        """Error callback for writing a batch, requeues it for a retry."""
+        self.queue.extendleft(reversed(batch))
+        self.delay = min(max(2 * self.delay, self.interval), self.maxdelay)
+        self.resume = time() + self.delay
+        log.msg("Writing {0} game results failed, retrying in {1:.0f}s: "
+                "{2}".format(len(batch), self.delay,
+                             error.getErrorMessage()))
+
+    def done(self, _):
+        """Allow the next write and continue with a full batch right away."""
+        self.writing = False
+        if len(self.queue) >= self.batchsize:
+            reactor.callLater(0, self.flush)
@@ -1,22 +1,280 @@
 # vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
 
 from datetime import datetime, timedelta
+from heapq import heappush, heappushpop
 from itertools import chain
+from math import exp, sqrt
+from time import time
 from urllib import urlencode
 
-from sqlalchemy import func
+from sqlalchemy import func, inspect, literal, select, union_all
 
-from twisted.internet.defer import Deferred, succeed
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, gatherResults, succeed
+from twisted.internet.threads import deferToThread
 from twisted.python import log
+from twisted.python.failure import Failure
 
 import trueskill
 # default values are fine, let's assume 0.3% draw chance
 trueskill.setup(draw_probability=0.003)
 
-from database import Session
-from database.models import Player, Game
+from names import NameIndex
+from replica import Session
+from database.models import Player, Game, UberAccount
 
 PASTATS_PLAYER_URL = "http://pastats.com/player"
+# matching players loaded per name, enough to tell ambiguous names apart
+MATCHES = 5
+
+# games are keyed by a monotonically increasing primary key
+GAME_KEY = inspect(Game).primary_key[0]
+
+# names suggested for unresolved player names
+SUGGESTIONS = 3
+# seconds between refreshes of the name index
+NAMES_REFRESH = 300
+
+
+class PlayerNotFound(Exception):
+    """Raised for names matching several players or only similar ones."""
+
+    def __init__(self, name, candidates, others=()):
+        """
+        Remember the name and the names to suggest instead. Others holds
+        (name, candidates) tuples of further names that didn't resolve.
+        """
+        Exception.__init__(self, name, candidates)
+        self.name = name
+        self.candidates = candidates
+        self.unresolved = [(name, candidates)] + list(others)
+
+
+class WDLCounters(object):
+    """
+    Materialized win/draw/loss counters for all ladder players.
+
+    Counters are built in a single grouped query and then kept up to date
+    incrementally, either by applying games newer than the last one read from
+    the database or by adding ingested games directly. Only reading from the
+    database moves the last key forward, ingested games are remembered until
+    then so they aren't counted twice.
+    """
+
+    def __init__(self):
+        """Initialize empty counters."""
+        self.counters = dict()
+        self.last_key = None
+        self.seen = set()
+
+    @property
+    def ready(self):
+        """Return True if the counters have been built at least once."""
+        return self.last_key is not None
+
+    def rebuild(self, session):
+        """Rebuild all counters with a single grouped query."""
+        log.msg("Rebuilding W/D/L counters.")
+        last_key = session.query(func.max(GAME_KEY)).scalar() or 0
+        rows = (session.query(Player.pid, Game.wid, func.count())
+                       .select_from(Game)
+                       .join(Game.players)
+                       .filter(GAME_KEY <= last_key)
+                       .group_by(Player.pid, Game.wid))
+
+        counters = dict()
+        for pid, wid, count in rows:
+            wdl = counters.setdefault(pid, [0, 0, 0])
+            if wid is None:
+                wdl[1] += count
+            elif wid == pid:
+                wdl[0] += count
+            else:
+                wdl[2] += count
+
+        self.counters = counters
+        self.last_key = last_key
+        self.seen = set()
+
+    def update(self, session):
+        """Apply all games newer than the last one seen."""
+        if not self.ready:
+            return self.rebuild(session)
+
+        rows = (session.query(GAME_KEY, Game.wid, Player.pid)
+                       .select_from(Game)
+                       .join(Game.players)
+                       .filter(GAME_KEY > self.last_key)
+                       .order_by(GAME_KEY))
+
+        games = dict()
+        for key, wid, pid in rows:
+            games.setdefault((key, wid), []).append(pid)
+        for (key, wid), pids in sorted(games.items()):
+            if key not in self.seen:
+                self.count(wid, pids)
+            self.last_key = max(self.last_key, key)
+        self.seen = set(key for key in self.seen if key > self.last_key)
+
+    def add_game(self, key, winner, pids):
+        """
+        Count an ingested game for all of its players.
+        Games are ignored until the counters have been built, the database
+        already contains them by then.
+        """
+        if not self.ready or key <= self.last_key or key in self.seen:
+            return
+        self.seen.add(key)
+        self.count(winner, pids)
+
+    def count(self, winner, pids):
+        """Count a single game for all of its players."""
+        for pid in pids:
+            wdl = self.counters.setdefault(pid, [0, 0, 0])
+            if winner is None:
+                wdl[1] += 1
+            elif winner == pid:
+                wdl[0] += 1
+            else:
+                wdl[2] += 1
+
+    def get(self, pid):
+        """Return a (wins, draws, losses) tuple for a player."""
+        return tuple(self.counters.get(pid, (0, 0, 0)))
+
+
+class MatchupMatrix(object):
+    """
+    TrueSkill match quality for all pairs of active ladder players.
+
+    Only the upper triangle of the quality matrix is computed, one row at a
+    time, and only the best pairs are retained, so memory stays bounded even
+    for large ladders. Results are cached until any active rating changes.
+    """
+
+    MAX_PAIRS = 100
+
+    def __init__(self, activity=28):
+        """Initialize an empty matrix for players active in the last days."""
+        self.activity = activity
+        self.version = None
+        self.best = list()
+
+    def invalidate(self):
+        """Force a recomputation on next access."""
+        self.version = None
+
+    def update(self, session):
+        """Recompute the best pairs if any active rating has changed."""
+        treshold = datetime.utcnow() - timedelta(self.activity)
+        # a plain tuple, query rows don't belong in snapshots
+        version = tuple(session.query(func.count(Player.pid),
+                                      func.max(Player.updated))
+                               .filter(Player.updated >= treshold)
+                               .one())
+        if version == self.version:
+            return
+
+        players = (session.query(Player)
+                          .filter(Player.updated >= treshold)
+                          .all())
+        self.best = self.compute([(p.name, p.skill) for p in players])
+        self.version = version
+
+    def compute(self, players):
+        """Return the best (quality, name1, name2) pairs, best first."""
+        beta_sq2 = 2 * trueskill.global_env().beta ** 2
+        names = [name for name, skill in players]
+        mus = [skill.mu for name, skill in players]
+        var = [skill.sigma ** 2 for name, skill in players]
+
+        heap = list()
+        count = len(players)
+        for i in range(count):
+            mu_i = mus[i]
+            base_i = beta_sq2 + var[i]
+            # upper triangle of row i: closed form of quality_1vs1
+            row = [(sqrt(beta_sq2 / (base_i + var[j])) *
+                    exp(-(mu_i - mus[j]) ** 2 / (2 * (base_i + var[j]))),
+                    j)
+                   for j in range(i + 1, count)]
+            for quality, j in row:
+                if len(heap) < self.MAX_PAIRS:
+                    heappush(heap, (quality, names[i], names[j]))
+                elif quality > heap[0][0]:
+                    heappushpop(heap, (quality, names[i], names[j]))
+
+        return sorted(heap, reverse=True)
+
+    def pairs(self, k):
+        """Return the k best pairs computed during the last update."""
+        return self.best[0:k]
+
+
+class BatchLoader(object):
+    """
+    Coalesces lookups made within a short tick into a single batch call.
+
+    Keys requested by concurrent commands are collected until the tick is
+    over, then batch is called once with all distinct keys and has to return
+    a list with one result per key. Every caller is answered from that list,
+    done is called once all of them have been answered. After a quiet
+    period, keys are dispatched on the next reactor iteration instead of
+    waiting for the tick.
+    """
+
+    def __init__(self, batch, tick=0.01, normalize=lambda key: key,
+                 clock=reactor, done=None):
+        """Remember the batch function and how long to collect keys."""
+        self.batch = batch
+        self.tick = tick
+        self.normalize = normalize
+        self.clock = clock
+        self.done = done
+        self.pending = dict()
+        self.call = None
+        self.last = None
+        self.batches = 0
+        self.loads = 0
+
+    def load(self, key):
+        """Return a Deferred firing with the result for key."""
+        self.loads += 1
+        waiting = self.pending.setdefault(self.normalize(key), (key, list()))
+        deferred = Deferred()
+        waiting[1].append(deferred)
+        if self.call is None:
+            now = self.clock.seconds()
+            quiet = self.last is None or now - self.last >= self.tick
+            self.call = self.clock.callLater(0 if quiet else self.tick,
+                                             self.dispatch)
+        return deferred
+
+    def loadMany(self, keys):
+        """Return a Deferred firing with a list of results for keys."""
+        return gatherResults([self.load(key) for key in keys],
+                             consumeErrors=True)
+
+    def dispatch(self):
+        """Run a single batch for all pending keys and answer all callers."""
+        pending, self.pending, self.call = self.pending.values(), dict(), None
+        self.last = self.clock.seconds()
+        self.batches += 1
+        try:
+            results = self.batch([key for key, waiting in pending])
+        except Exception:
+            log.err(None, "Batch lookup failed.")
+            for key, waiting in pending:
+                for deferred in waiting:
+                    deferred.errback()
+        else:
+            for (key, waiting), result in zip(pending, results):
+                for deferred in waiting:
+                    deferred.callback(result)
+        finally:
+            # results may be shared by callers, release them only now
+            if self.done is not None:
+                self.done()
 
 
 class LadderParser(object):
@@ -28,20 +286,254 @@ class LadderParser(object):
     applications.
     """
 
+    # cached attributes kept in snapshots
+    SNAPSHOT = ("wdl", "matchups")
+
     def __init__(self):
         """Initialize database connection."""
         log.msg("Initializing Ladder parser.")
         self.session = Session()
+        self.wdl = WDLCounters()
+        self.matchups = MatchupMatrix()
+        self.matchups_waiting = list()
+        self.loader = BatchLoader(self.loadPlayers,
+                                  normalize=lambda name: name.lower(),
+                                  done=lambda: self.session.close())
+        self.names = NameIndex()
+        self.names_updated = None
+        self.names_refreshed = 0
+
+    def warm_up(self):
+        """
+        Build all in-memory ladder structures.
+        The W/D/L counters and the matchups are built in a worker thread with
+        a session of its own and replace the current ones once they're done.
+        Returns a Deferred firing when everything is in place.
+        """
+        deferred = deferToThread(self.build, not self.wdl.ready)
+        deferred.addCallback(self.install)
+        deferred.addCallback(lambda _: self.refreshNames())
+        return deferred
+
+    def build(self, counters):
+        """
+        Return new W/D/L counters (or None unless counters is True) and a new
+        matchup matrix. Runs in a worker thread.
+        """
+        session = Session()
+        try:
+            wdl = None
+            if counters:
+                wdl = WDLCounters()
+                wdl.rebuild(session)
+            matchups = MatchupMatrix(self.matchups.activity)
+            matchups.update(session)
+            return wdl, matchups
+        finally:
+            session.close()
+
+    def install(self, built):
+        """Replace the in-memory structures with those built in the thread."""
+        wdl, matchups = built
+        # counters restored from a snapshot only need to catch up
+        if wdl is not None and not self.wdl.ready:
+            self.wdl = wdl
+        self.matchups = matchups
+
+    def refreshNames(self):
+        """
+        Refresh the name index in a worker thread.
+        The first refresh builds the whole index there, later ones only read
+        the players and accounts updated since and apply them here. Returns
+        a Deferred firing when the index is up to date.
+        """
+        self.names_refreshed = time()
+        deferred = deferToThread(self.readNames, self.names_updated)
+        deferred.addCallback(self.applyNames)
+        deferred.addErrback(log.err, "Refreshing player names failed.")
+        return deferred
+
+    def readNames(self, since):
+        """
+        Read player names and display names updated since the (players,
+        accounts) times in since, or all of them if it's None. Runs in a
+        worker thread with a session of its own.
+        Returns a new index holding all names if since is None, otherwise
+        the rows to apply, and the latest update times.
+        """
+        session = Session()
+        try:
+            latest = (session.query(func.max(Player.updated)).scalar(),
+                      session.query(func.max(UberAccount.updated)).scalar())
+            players = session.query(Player.pid, Player.name, Player.rating)
+            accounts = session.query(UberAccount.uid, UberAccount.dname)
+            if since is not None and since[0] is not None:
+                players = players.filter(Player.updated >= since[0])
+            if since is not None and since[1] is not None:
+                accounts = accounts.filter(UberAccount.updated >= since[1])
+            players, accounts = players.all(), accounts.all()
+        finally:
+            session.close()
+
+        if since is not None:
+            return None, players, accounts, latest
+        index = NameIndex()
+        self.indexNames(index, players, accounts)
+        return index, (), (), latest
+
+    def applyNames(self, result):
+        """Install a new name index or apply changed names to the current."""
+        index, players, accounts, latest = result
+        if index is not None:
+            self.names = index
+        self.indexNames(self.names, players, accounts)
+        self.names_updated = latest
+
+    @staticmethod
+    def indexNames(index, players, accounts):
+        """
+        Add player names and display names to index, replacing the previous
+        names of renamed players and accounts. Players are ranked by rating,
+        display names that aren't player names come last.
+        """
+        for pid, name, rating in players:
+            index.add(name, (0, -rating), ("player", pid))
+        for uid, dname in accounts:
+            if dname is None:
+                index.discard(("account", uid))
+            else:
+                index.add(dname, (1, 0), ("account", uid))
+
+    def suggestions(self, name):
+        """
+        Return the known names closest to a name matching no player.
+        A stale index is refreshed in the background, this lookup still uses
+        the current one.
+        """
+        if time() - self.names_refreshed > NAMES_REFRESH:
+            self.refreshNames()
+        return self.names.lookup(name, SUGGESTIONS)
 
     def getPlayer(self, name):
         """Return a player dictionary for a given name or None if not found."""
-        player = (self.session.query(Player)
-                  .filter(Player.name.ilike("%"+name+"%"))
-                  .first())
-        if player:
-            return player
+        player, candidates = self.getPlayers([name])[0]
+        return player
+
+    def loadPlayers(self, names):
+        """
+        Batch function for the player loader.
+        The W/D/L counters are caught up once per batch as well, but only
+        once warm-up has built them in a worker thread.
+        """
+        if self.wdl.ready:
+            self.wdl.update(self.session)
+        return self.getPlayers(names)
+
+    def getPlayers(self, names):
+        """
+        Resolve several (partial) player names.
+
+        Returns a list containing a (player, candidates) tuple for each name.
+        An exact (case insensitive) match is preferred, otherwise a single
+        partial match is chosen. Candidates hold the names of all matching
+        players, highest rated first, or the closest known names if there are
+        none. Ambiguous and unknown names have no player.
+        """
+        if not names:
+            return list()
+
+        matches = [list() for name in names]
+        for index, player in self.playersQuery(names):
+            matches[index].append(player)
+
+        results = list()
+        for name, found in zip(names, matches):
+            lower = name.lower()
+            exact = [p for p in found if p.name.lower() == lower]
+            if exact:
+                player = exact[0]
+            elif len(found) == 1:
+                player = found[0]
+            else:
+                player = None
+            candidates = [p.name for p in found] or self.suggestions(name)
+            results.append((player, candidates))
+
+        return results
+
+    def notFound(self, deferred, name, candidates):
+        """
+        Fire deferred for a name that didn't resolve to a player.
+        Fails with PlayerNotFound if there are names to suggest instead,
+        otherwise fires with None.
+        """
+        if candidates:
+            deferred.errback(PlayerNotFound(name, candidates[:SUGGESTIONS]))
         else:
-            return None
+            deferred.callback(None)
+
+    def failed(self, failure, deferred):
+        """
+        Roll back the session after a failed query and fail deferred.
+        Without it a broken transaction would be reused by the next command.
+        """
+        self.session.close()
+        deferred.errback(failure)
+
+    def playersQuery(self, names):
+        """
+        Return the query for (index, player) rows of up to MATCHES players
+        whose name contains each of names, all in a single round trip. Rows
+        are ordered by the index of the name, then an exact (case
+        insensitive) match first and then by rating.
+        Substring matches can use a trigram index on the player name.
+        """
+        patterns = list()
+        for index, name in enumerate(names):
+            escaped = (name.replace("\\", "\\\\").replace("%", "\\%")
+                           .replace("_", "\\_"))
+            patterns.append(select([literal(index).label("index"),
+                                    literal(u"%{0}%".format(escaped))
+                                    .label("pattern"),
+                                    literal(name.lower()).label("lower")]))
+        patterns = union_all(*patterns).alias("patterns")
+
+        order = ((func.lower(Player.name) == patterns.c.lower).desc(),
+                 Player.rating.desc())
+        ranked = (select([Player.pid, patterns.c.index,
+                          func.row_number()
+                              .over(partition_by=patterns.c.index,
+                                    order_by=order)
+                              .label("position")])
+                  .where(Player.name.ilike(patterns.c.pattern, escape="\\"))
+                  .alias("ranked"))
+
+        return (self.session.query(ranked.c.index, Player)
+                .join(Player, Player.pid == ranked.c.pid)
+                .filter(ranked.c.position <= MATCHES)
+                .order_by(ranked.c.index, ranked.c.position))
+
+    def topQuery(self, activity):
+        """
+        Return the query for the names of the ten highest rated players
+        active in the last activity days (all players if activity is 0).
+        """
+        query = self.session.query(Player.name)
+        if activity:
+            treshold = datetime.utcnow() - timedelta(activity)
+            query = query.filter(Player.updated >= treshold)
+        return query.order_by(Player.rating.desc()).limit(10)
+
+    def activeQuery(self, treshold, above=None):
+        """
+        Return the query counting players active since treshold, only those
+        rated higher than above if given.
+        """
+        query = (self.session.query(func.count(Player.pid))
+                             .filter(Player.updated >= treshold))
+        if above is not None:
+            query = query.filter(Player.rating > above)
+        return query
 
     def top(self, activity):
         """Start an update and return a deferred containing the results."""
@@ -50,87 +542,77 @@ class LadderParser(object):
 
         def updateDone(value):
             """Callback method for update."""
-            top_query = self.session.query(Player.name)
-
-            if activity:
-                treshold = datetime.utcnow() - timedelta(activity)
-                top_query = top_query.filter(Player.updated >= treshold)
-
-            top_query = top_query.order_by(Player.rating.desc()).limit(10)
-
-            top = chain(*top_query.all())
+            top = chain(*self.topQuery(activity).all())
             newDeferred.callback(list(top))
 
             self.session.close()
 
         updateDeferred.addCallback(updateDone)
+        updateDeferred.addErrback(self.failed, newDeferred)
 
         return newDeferred
 
     def stats(self, user):
         """Start an update and return a deferred containing the results."""
-        updateDeferred = succeed(None)
+        updateDeferred = self.loader.load(user)
         newDeferred = Deferred()
 
         def updateDone(value):
             """Callback method for update."""
-            player = self.getPlayer(user)
+            player, candidates = value
             if player is None:
-                newDeferred.callback(None)
+                self.notFound(newDeferred, user, candidates)
             else:
                 player_url = ("{0}?{1}"
                               .format(PASTATS_PLAYER_URL,
                                       urlencode({"player": player.pid})))
-                w, d, l = player.wdl
+                w, d, l = self.wdl.get(player.pid)
                 newDeferred.callback((player.name, w, d, l, player_url))
 
-            self.session.close()
-
         updateDeferred.addCallback(updateDone)
+        updateDeferred.addErrback(self.failed, newDeferred)
 
         return newDeferred
 
     def rank(self, user):
         """Start an update and return a deferred containing the results."""
-        updateDeferred = succeed(None)
+        updateDeferred = self.loader.load(user)
         newDeferred = Deferred()
 
         def updateDone(value):
             """Callback method for update."""
-            player = self.getPlayer(user)
+            player, candidates = value
 
             treshold = datetime.utcnow() - timedelta(28)
-            qry_count = (self.session.query(func.count(Player.pid))
-                                     .filter(Player.updated >= treshold))
-            total = qry_count.scalar()
+            total = self.activeQuery(treshold).scalar()
 
             if player is None:
-                newDeferred.callback(None)
+                self.notFound(newDeferred, user, candidates)
             elif player.updated < treshold:
                 newDeferred.callback((player.name, None, total))
             else:
-                cmp_rating = (self.session.query(Player.rating)
-                                  .filter(Player.pid == player.pid).subquery())
-                rank = qry_count.filter(Player.rating > cmp_rating).scalar()
+                rank = self.activeQuery(treshold, player.rating).scalar()
                 newDeferred.callback((player.name, 1 + rank, total))
 
-            self.session.close()
-
         updateDeferred.addCallback(updateDone)
+        updateDeferred.addErrback(self.failed, newDeferred)
 
         return newDeferred
 
     def forecast(self, user1, user2):
         """Start an update and return a deferred containing the results."""
-        updateDeferred = succeed(None)
+        updateDeferred = self.loader.loadMany([user1, user2])
         newDeferred = Deferred()
 
         def updateDone(value):
             """Callback method for update."""
-            p1 = self.getPlayer(user1)
-            p2 = self.getPlayer(user2)
+            (p1, c1), (p2, c2) = value
 
-            if p1 is None or p2 is None or p1 == p2:
+            if p1 is None:
+                self.notFound(newDeferred, user1, c1)
+            elif p2 is None:
+                self.notFound(newDeferred, user2, c2)
+            elif p1 == p2:
                 newDeferred.callback(None)
             else:
                 newDeferred.callback((p1.name, p2.name,
@@ -138,22 +620,21 @@ class LadderParser(object):
                                                              p2.skill),
                                       p1.rating, p2.rating))
 
-            self.session.close()
-
         updateDeferred.addCallback(updateDone)
+        updateDeferred.addErrback(self.failed, newDeferred)
 
         return newDeferred
 
     def suggest(self, user, n):
         """Start an update and return a deferred containing the results."""
-        updateDeferred = succeed(None)
+        updateDeferred = self.loader.load(user)
         newDeferred = Deferred()
 
         def updateDone(value):
             """Callback method for update."""
-            player = self.getPlayer(user)
+            player, candidates = value
             if player is None:
-                newDeferred.callback(None)
+                self.notFound(newDeferred, user, candidates)
             else:
                 players = (self.session.query(Player)
                            .filter(Player.pid != player.pid)
@@ -167,23 +648,25 @@ class LadderParser(object):
                 best_names = [p[0] for p in best[0:n]]
                 newDeferred.callback((player.name, best_names))
 
-            self.session.close()
-
         updateDeferred.addCallback(updateDone)
+        updateDeferred.addErrback(self.failed, newDeferred)
 
         return newDeferred
 
     def ratio(self, user1, user2):
         """Start an update and return a deferred containing the results."""
-        updateDeferred = succeed(None)
+        updateDeferred = self.loader.loadMany([user1, user2])
         newDeferred = Deferred()
 
         def updateDone(value):
             """Callback method for update."""
-            p1 = self.getPlayer(user1)
-            p2 = self.getPlayer(user2)
+            (p1, c1), (p2, c2) = value
 
-            if p1 is None or p2 is None or p1 == p2:
+            if p1 is None:
+                self.notFound(newDeferred, user1, c1)
+            elif p2 is None:
+                self.notFound(newDeferred, user2, c2)
+            elif p1 == p2:
                 newDeferred.callback(None)
             else:
                 games = (self.session.query(Game)
@@ -196,8 +679,90 @@ class LadderParser(object):
                 newDeferred.callback((p1.name, p2.name,
                                       len(games), p1_wins, p2_wins))
 
-            self.session.close()
+        updateDeferred.addCallback(updateDone)
+        updateDeferred.addErrback(self.failed, newDeferred)
+
+        return newDeferred
+
+    def compare(self, users):
+        """Start an update and return a deferred containing the results."""
+        updateDeferred = self.loader.loadMany(users)
+        newDeferred = Deferred()
+
+        def updateDone(value):
+            """Callback method for update."""
+            result = list()
+            unresolved = list()
+            for user, (player, candidates) in zip(users, value):
+                if player is None:
+                    result.append((user, None, None))
+                    if candidates:
+                        unresolved.append((user, candidates))
+                else:
+                    result.append((player.name, player.rating,
+                                   self.wdl.get(player.pid)))
+
+            if unresolved:
+                unresolved = [(user, candidates[:SUGGESTIONS])
+                              for user, candidates in unresolved]
+                newDeferred.errback(PlayerNotFound(*unresolved[0],
+                                                   others=unresolved[1:]))
+            else:
+                newDeferred.callback(result)
 
         updateDeferred.addCallback(updateDone)
+        updateDeferred.addErrback(self.failed, newDeferred)
 
         return newDeferred
+
+    def matchup(self, n):
+        """
+        Return a deferred containing the n best matchups.
+        Matchups are recomputed in a worker thread whenever ratings have
+        changed, the cached ones are served meanwhile unless there are none.
+        """
+        if self.matchups.version is None:
+            deferred = self.refreshMatchups()
+            deferred.addCallback(lambda matchups: matchups.pairs(n))
+            return deferred
+
+        self.refreshMatchups().addErrback(log.err, "Updating matchups failed.")
+        return succeed(self.matchups.pairs(n))
+
+    def refreshMatchups(self):
+        """
+        Recompute the matchups in a worker thread unless that's happening
+        already. Returns a Deferred firing with the up to date matchups.
+        """
+        deferred = Deferred()
+        self.matchups_waiting.append(deferred)
+        if len(self.matchups_waiting) == 1:
+            thread = deferToThread(self.buildMatchups, self.matchups)
+            thread.addBoth(self.installMatchups)
+        return deferred
+
+    def buildMatchups(self, current):
+        """
+        Return a copy of the current matchups, recomputed if any active
+        rating has changed. Runs in a worker thread with a session of its own.
+        """
+        session = Session()
+        try:
+            matchups = MatchupMatrix(current.activity)
+            matchups.version, matchups.best = current.version, current.best
+            matchups.update(session)
+            return matchups
+        finally:
+            session.close()
+
+    def installMatchups(self, result):
+        """Install recomputed matchups and answer everyone waiting for them."""
+        waiting, self.matchups_waiting = self.matchups_waiting, list()
+        if isinstance(result, Failure):
+            for deferred in waiting:
+                deferred.errback(result)
+            return
+
+        self.matchups = result
+        for deferred in waiting:
+            deferred.callback(result)
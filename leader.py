@@ -1,6 +1,6 @@
 # vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
 
-from database import Session
+from replica import Session
 from database.models import LeaderBoardEntry, UberAccount
 
 from twisted.internet.defer import Deferred, succeed
@@ -19,27 +19,33 @@ class LeaderParser(object):
         log.msg("Initializing Ubernet Leaderboard parser.")
         self.session = Session()
 
+    def failed(self, failure, deferred):
+        """Roll back the session and fail deferred with failure."""
+        self.session.close()
+        deferred.errback(failure)
+
     def top(self, league):
         """Start an update and return a deferred containing the results."""
         updateDeferred = succeed(None)
         newDeferred = Deferred()
 
-        league = league.capitalize()
-
         def updateDone(value):
             """Callback method for update."""
-            entries = (self.session.query(LeaderBoardEntry.uid,
-                                          UberAccount.dname)
-                           .outerjoin(UberAccount,
-                                      UberAccount.uid == LeaderBoardEntry.uid)
-                           .filter(LeaderBoardEntry.game == "Titans",
-                                   LeaderBoardEntry.league == league)
-                           .order_by(LeaderBoardEntry.rank))
-
+            entries = self.topQuery(league)
             newDeferred.callback([e[1] for e in entries])
 
             self.session.close()
 
         updateDeferred.addCallback(updateDone)
+        updateDeferred.addErrback(self.failed, newDeferred)
 
         return newDeferred
+
+    def topQuery(self, league):
+        """Return the query for the ranked display names of a league."""
+        return (self.session.query(LeaderBoardEntry.uid, UberAccount.dname)
+                    .outerjoin(UberAccount,
+                               UberAccount.uid == LeaderBoardEntry.uid)
+                    .filter(LeaderBoardEntry.game == "Titans",
+                            LeaderBoardEntry.league == league.capitalize())
+                    .order_by(LeaderBoardEntry.rank))
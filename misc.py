@@ -8,6 +8,9 @@ from twisted.internet.defer import Deferred
 from twisted.python import log
 from twisted.web.client import getPage
 
+from breaker import CircuitBreaker
+from deadline import http_timeout
+
 UBERNET_NEWS_URL = "http://uberent.com/GameClient/GetNews"
 
 
@@ -18,21 +21,27 @@ class MiscParser(object):
     It supports reading a variety of different APIs returning JSON data.
     """
 
+    # cached attributes kept in snapshots
+    SNAPSHOT = ("items",)
+
     def __init__(self):
-        """Do nothing for now."""
-        pass
+        """Initialize the news cache and the Uberent circuit breaker."""
+        self.items = list()
+        self.breaker = CircuitBreaker("uberent")
 
-    def startNewsUpdate(self, count):
+    def startNewsUpdate(self, count, deadline=None):
         """
         Initiate an update using Twisted.
 
         The request is handled asynchronously. It will call onUpdate if it's
         successful and onError otherwise.
         """
-        log.msg("Updating URL contents for: {0}".format(UBERNET_NEWS_URL))
+        log.msg(format="Updating URL contents for: %(url)s",
+                url=UBERNET_NEWS_URL, logKey="news.request")
         url = "{0}?{1}".format(UBERNET_NEWS_URL, urlencode({"titleid": 4,
                                                             "count": count}))
-        deferred = getPage(url)
+        deferred = self.breaker.call(getPage, url,
+                                     timeout=http_timeout(deadline))
         deferred.addCallback(self.onNewsUpdate)
         return deferred
 
@@ -45,12 +54,14 @@ class MiscParser(object):
                  "title": item["Title"]}
                 for item in data["News"]]
 
-        log.msg("Received and parsed new data: {0}".format(news))
+        log.msg(format="Received and parsed %(count)d news items: %(news)s",
+                count=len(news), news=news, logKey="news.update")
+        self.items = news
         return news
 
-    def news(self, count):
+    def news(self, count, deadline=None):
         """Start an update and return a deferred containing the results."""
-        updateDeferred = self.startNewsUpdate(count)
+        updateDeferred = self.startNewsUpdate(count, deadline)
         newDeferred = Deferred()
         updateDeferred.addCallbacks(newDeferred.callback, newDeferred.errback)
         return newDeferred
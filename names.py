@@ -0,0 +1,149 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+names.py
+
+Typo tolerant lookup of player names.
+Names are indexed with the symmetric delete algorithm (SymSpell): every name
+is stored under all variants with up to distance characters deleted, so
+candidates for a misspelled name are found by a few dictionary lookups of
+its own delete variants instead of comparing it to every known name.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+
+def edit_distance(a, b, limit):
+    """
+    Return the optimal string alignment distance of a and b, counting
+    insertions, deletions, substitutions and transpositions of adjacent
+    characters. Returns limit + 1 as soon as the distance exceeds limit.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    before, previous = None, range(len(b) + 1)
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1,
+                       previous[j - 1] + (ca != cb))
+            if (i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb and
+                    before[j - 2] + 1 < cost):
+                cost = before[j - 2] + 1
+            current.append(cost)
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return previous[-1]
+
+
+class NameIndex(object):
+    """
+    Index of names for typo tolerant, case insensitive lookups.
+
+    Every name belongs to one or more owners (the name itself by default)
+    and has a rank per owner, lookups return names of equal distance ordered
+    by their best rank (lower first). An owner has a single name, adding
+    another one for it replaces the old one. Each indexed name costs about
+    len(name) ** distance dictionary entries, so a distance of 1 keeps the
+    index small enough for the whole ladder.
+    """
+
+    def __init__(self, distance=1):
+        """Initialize an empty index."""
+        self.distance = distance
+        self.names = dict()
+        self.deletes = dict()
+        self.owners = dict()
+        self.refs = dict()
+
+    def __len__(self):
+        """Return the number of indexed names."""
+        return len(self.names)
+
+    def __contains__(self, name):
+        """Return True if name is indexed, ignoring case."""
+        return name.lower() in self.names
+
+    def variants(self, word):
+        """Return word and all words with up to distance characters deleted."""
+        variants = set([word])
+        frontier = variants
+        for _ in range(self.distance):
+            frontier = set(w[:i] + w[i + 1:]
+                           for w in frontier for i in range(len(w)))
+            variants |= frontier
+        return variants
+
+    def add(self, name, rank=0, owner=None):
+        """Add name of owner or update its rank."""
+        key = name.lower()
+        if owner is None:
+            owner = key
+        if self.owners.get(owner, key) != key:
+            self.discard(owner)
+        self.owners[owner] = key
+
+        refs = self.refs.setdefault(key, dict())
+        refs[owner] = (rank, name)
+        if key in self.names:
+            self.names[key] = min(refs.itervalues())
+            return
+
+        self.names[key] = (rank, name)
+        for variant in self.variants(key):
+            # most variants belong to a single name, don't waste a list
+            keys = self.deletes.get(variant)
+            if keys is None:
+                self.deletes[variant] = key
+            elif isinstance(keys, list):
+                keys.append(key)
+            else:
+                self.deletes[variant] = [keys, key]
+
+    def discard(self, owner):
+        """Remove the name of owner unless other owners have it as well."""
+        key = self.owners.pop(owner, None)
+        if key is None:
+            return
+
+        refs = self.refs[key]
+        del refs[owner]
+        if refs:
+            self.names[key] = min(refs.itervalues())
+            return
+
+        del self.refs[key]
+        del self.names[key]
+        for variant in self.variants(key):
+            keys = self.deletes[variant]
+            if not isinstance(keys, list):
+                del self.deletes[variant]
+                continue
+            keys.remove(key)
+            if len(keys) == 1:
+                self.deletes[variant] = keys[0]
+
+    def lookup(self, name, n=3):
+        """Return up to n indexed names closest to name, best first."""
+        key = name.lower()
+        candidates = set()
+        for variant in self.variants(key):
+            keys = self.deletes.get(variant)
+            if keys is None:
+                continue
+            elif isinstance(keys, list):
+                candidates.update(keys)
+            else:
+                candidates.add(keys)
+
+        matches = list()
+        for candidate in candidates:
+            distance = edit_distance(key, candidate, self.distance)
+            if distance <= self.distance:
+                rank, original = self.names[candidate]
+                matches.append((distance, rank, original))
+
+        return [match[2] for match in sorted(matches)[:n]]
@@ -0,0 +1,64 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+pager.py
+
+Per-nick cursors into long results.
+The remaining lines of a result are kept for a limited time, so users can
+request them page by page.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+from collections import OrderedDict, deque
+from time import time
+
+
+class Pager(object):
+    """
+    Bounded store of pending lines per nick.
+    At most maxsize nicks are remembered, the least recently used are evicted
+    first. Lines expire ttl seconds after they were stored.
+    """
+
+    def __init__(self, maxsize=100, ttl=600):
+        """Initialize an empty store."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.cursors = OrderedDict()
+
+    def purge(self):
+        """Remove expired cursors."""
+        now = time()
+        for nick, (expires, lines) in self.cursors.items():
+            if expires < now:
+                del self.cursors[nick]
+
+    def store(self, nick, lines):
+        """Remember lines for nick, replacing what was stored before."""
+        self.purge()
+        self.cursors.pop(nick, None)
+        if not lines:
+            return
+        self.cursors[nick] = (time() + self.ttl, deque(lines))
+        while len(self.cursors) > self.maxsize:
+            self.cursors.popitem(last=False)
+
+    def next(self, nick, count):
+        """Return up to count lines for nick and advance the cursor."""
+        self.purge()
+        cursor = self.cursors.pop(nick, None)
+        if not cursor:
+            return list()
+
+        expires, lines = cursor
+        page = [lines.popleft() for _ in range(min(count, len(lines)))]
+        if lines:
+            self.cursors[nick] = cursor
+        return page
+
+    def remaining(self, nick):
+        """Return the number of lines left for nick."""
+        cursor = self.cursors.get(nick)
+        return len(cursor[1]) if cursor and cursor[0] >= time() else 0
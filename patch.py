@@ -3,7 +3,7 @@
 from twisted.internet.defer import Deferred, succeed
 from twisted.python import log
 
-from database import Session
+from replica import Session
 from database.models import Patch
 
 
@@ -21,6 +21,11 @@ class PatchParser(object):
         log.msg("Initializing Ubernet Patch parser.")
         self.session = Session()
 
+    def failed(self, failure, deferred):
+        """Roll back the session and fail deferred with failure."""
+        self.session.close()
+        deferred.errback(failure)
+
     def patches(self):
         """Start an update and return a deferred containing the results."""
         updateDeferred = succeed(None)
@@ -43,5 +48,6 @@ class PatchParser(object):
             self.session.close()
 
         updateDeferred.addCallback(updateDone)
+        updateDeferred.addErrback(self.failed, newDeferred)
 
         return newDeferred
@@ -0,0 +1,138 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+profiler.py
+
+On-demand profiling of the running bot.
+It supports deterministic profiling with cProfile, statistical sampling of
+the reactor thread and snapshots of live objects to find memory growth.
+All results are written to files in the configured directory.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+import gc
+import sys
+
+from cProfile import Profile
+from collections import Counter
+from datetime import datetime
+from os.path import join
+from pstats import Stats
+from thread import get_ident
+from time import sleep, time
+
+from twisted.internet import reactor
+from twisted.internet.defer import fail
+from twisted.internet.task import deferLater
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+
+
+class ProfilerBusy(Exception):
+    """Raised when a profiling run is already in progress."""
+
+
+class Profiler(object):
+    """
+    Starts profiling runs of limited duration and writes their results.
+    Only one run can be active at a time. Every method returns a Deferred
+    firing with the name of the file written.
+    """
+
+    def __init__(self, path):
+        """Remember where to write results."""
+        self.path = path
+        self.busy = False
+        self.objects = None
+
+    def filename(self, kind, extension):
+        """Return a timestamped file name for a result."""
+        return join(self.path, "{0}-{1}.{2}".format(
+            kind, datetime.utcnow().strftime("%Y%m%d-%H%M%S"), extension))
+
+    def run(self, kind, func, *args):
+        """Run func unless another run is active."""
+        if self.busy:
+            return fail(ProfilerBusy("Profiler is busy."))
+
+        log.msg("Starting {0} profiling.".format(kind))
+        self.busy = True
+
+        def done(result):
+            """Allow the next run and pass on the result."""
+            self.busy = False
+            log.msg("Finished {0} profiling: {1}".format(kind, result))
+            return result
+
+        return func(*args).addBoth(done)
+
+    def profile(self, seconds):
+        """Profile the reactor thread with cProfile for some seconds."""
+        def start():
+            """Enable the profiler and disable it again after seconds."""
+            profile = Profile()
+            profile.enable()
+            return deferLater(reactor, seconds, stop, profile)
+
+        def stop(profile):
+            """Disable the profiler and write binary and text results."""
+            profile.disable()
+            filename = self.filename("cprofile", "pstats")
+            profile.dump_stats(filename)
+            with open(filename[:-len("pstats")] + "txt", "w") as text:
+                stats = Stats(profile, stream=text)
+                stats.sort_stats("cumulative").print_stats(50)
+            return filename
+
+        return self.run("cProfile", lambda: deferLater(reactor, 0, start))
+
+    def sample(self, seconds, interval=0.005):
+        """Sample the reactor thread's stack for some seconds."""
+        reactor_thread = get_ident()
+
+        def collect():
+            """Count collapsed stacks in a separate thread."""
+            stacks = Counter()
+            end = time() + seconds
+            while time() < end:
+                frame = sys._current_frames().get(reactor_thread)
+                stack = list()
+                while frame:
+                    code = frame.f_code
+                    stack.append("{0}:{1}:{2}".format(
+                        code.co_filename, frame.f_lineno, code.co_name))
+                    frame = frame.f_back
+                stacks[";".join(reversed(stack))] += 1
+                sleep(interval)
+
+            # collapsed format as understood by flame graph tools
+            filename = self.filename("samples", "txt")
+            with open(filename, "w") as result:
+                for stack, count in stacks.most_common():
+                    result.write("{0} {1}\n".format(stack, count))
+            return filename
+
+        return self.run("sampling", deferToThread, collect)
+
+    def snapshot(self, top=50):
+        """
+        Count live objects by type and write the top types along with their
+        growth since the previous snapshot.
+        """
+        def take():
+            """Count objects and write the comparison."""
+            gc.collect()
+            objects = Counter(type(o).__name__ for o in gc.get_objects())
+            previous, self.objects = self.objects, objects
+
+            filename = self.filename("objects", "txt")
+            with open(filename, "w") as result:
+                for name, count in objects.most_common(top):
+                    growth = count - previous[name] if previous else 0
+                    result.write("{0:<40} {1:>10} {2:>+10}\n".format(
+                        name, count, growth))
+            return filename
+
+        return self.run("memory", lambda: deferLater(reactor, 0, take))
@@ -0,0 +1,176 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+recorder.py
+
+Traffic recorder for the Commander IRC bot.
+It captures inbound commands, outbound lines and the results of all parser
+calls to a compact log file that can be replayed with bench.replay.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+from cPickle import (dumps, load, HIGHEST_PROTOCOL, PicklingError,
+                     UnpicklingError)
+from gzip import GzipFile
+from time import time
+from zlib import error as ZlibError
+
+from twisted.application import service
+from twisted.internet.defer import Deferred
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from deadline import Deadline
+
+
+def read_records(path):
+    """
+    Yield all records stored in a recording.
+    Recordings of bots that didn't stop cleanly end in a truncated record,
+    everything before it is returned.
+    """
+    with GzipFile(path, "rb") as recording:
+        while True:
+            try:
+                yield load(recording)
+            except EOFError:
+                return
+            except (IOError, UnpicklingError, ValueError, ZlibError) as error:
+                log.msg("Recording {0} is truncated: {1}".format(path, error))
+                return
+
+
+class RecordingProxy(object):
+    """
+    Wraps a parser and records the results of all Deferred returning calls.
+    Everything else is passed through unchanged.
+    """
+
+    def __init__(self, parser, name, recorder):
+        """Remember the wrapped parser."""
+        self._parser = parser
+        self._name = name
+        self._recorder = recorder
+
+    def __getattr__(self, attr):
+        """Return attributes of the parser, wrapping its public methods."""
+        value = getattr(self._parser, attr)
+        if attr.startswith("_") or not callable(value):
+            return value
+
+        def recorded(*args):
+            """Call the parser method and record its result."""
+            started = time()
+            result = value(*args)
+            if isinstance(result, Deferred):
+                # deadlines differ between runs, they aren't recorded
+                recorded_args = tuple(arg for arg in args
+                                      if not isinstance(arg, Deadline))
+                result.addBoth(self._recorder.call, self._name, attr,
+                               recorded_args, started)
+            return result
+
+        return recorded
+
+
+class TrafficRecorder(service.Service):
+    """
+    Records traffic of a running bot.
+
+    Records are pickled tuples appended to a gzip compressed file:
+    - ("in", t, user, channel, msg) for handled commands
+    - ("out", t, line) for lines sent to the server
+    - ("call", t, parser, method, args, duration, result) for parser calls
+    Times are seconds since recording started. Failed calls are stored with
+    an ("error", message) result. While the service runs, the file is flushed
+    every interval seconds, so a killed bot leaves at most that much
+    unreadable. It's closed when the service stops.
+    """
+
+    def __init__(self, path, interval=5):
+        """Open the recording file."""
+        log.msg("Recording traffic to {0}.".format(path))
+        self.path = path
+        self.interval = interval
+        self.started = time()
+        self.recording = GzipFile(path, "ab")
+        self.flusher = LoopingCall(self.flush)
+
+    def startService(self):
+        """Start flushing the recording."""
+        service.Service.startService(self)
+        self.flusher.start(self.interval, False)
+
+    def stopService(self):
+        """Stop flushing and close the recording."""
+        service.Service.stopService(self)
+        if self.flusher.running:
+            self.flusher.stop()
+        self.close()
+
+    def flush(self):
+        """Make everything recorded so far readable."""
+        if self.recording:
+            self.recording.flush()
+
+    def write(self, record):
+        """Append a single record."""
+        if not self.recording:
+            return
+        try:
+            self.recording.write(dumps(record, HIGHEST_PROTOCOL))
+        except (PicklingError, TypeError) as error:
+            log.msg("Cannot record {0}: {1}".format(record[0], error))
+
+    def inbound(self, user, channel, msg):
+        """Record a command received from the server."""
+        self.write(("in", time() - self.started, user, channel, msg))
+
+    def outbound(self, line):
+        """Record a line sent to the server."""
+        self.write(("out", time() - self.started, line))
+
+    def call(self, result, parser, method, args, started):
+        """Record the result of a parser call and pass it on."""
+        if isinstance(result, Failure):
+            value = ("error", result.getErrorMessage())
+        else:
+            value = result
+        self.write(("call", started - self.started, parser, method, args,
+                    time() - started, value))
+        return result
+
+    def install(self, bot_class):
+        """
+        Start recording the parsers and traffic of a bot class.
+        Parsers that haven't been created yet are wrapped once they are.
+        """
+        for name, attr in vars(bot_class).items():
+            if not hasattr(attr, "parser_class"):
+                continue
+            attr.wrap = (lambda parser, name=name:
+                         RecordingProxy(parser, name, self))
+            if (attr.parser is not None and
+                    not isinstance(attr.parser, RecordingProxy)):
+                attr.parser = attr.wrap(attr.parser)
+        bot_class.recorder = self
+
+    def uninstall(self, bot_class):
+        """Stop recording the parsers and traffic of a bot class."""
+        for name, attr in vars(bot_class).items():
+            if not hasattr(attr, "parser_class"):
+                continue
+            attr.wrap = None
+            if isinstance(attr.parser, RecordingProxy):
+                attr.parser = attr.parser._parser
+        bot_class.recorder = None
+
+    def close(self):
+        """Stop recording and close the file."""
+        log.msg("Stopped recording traffic to {0}.".format(self.path))
+        recording, self.recording = self.recording, None
+        if recording:
+            recording.close()
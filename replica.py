@@ -0,0 +1,177 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+replica.py
+
+Local SQLite read replica of the ladder, leaderboard, tournament and patch
+tables.
+If a replica path is configured, all parsers read through the Session
+exported here instead of querying the database at DATABASE_URL. ReplicaSync
+keeps the replica up to date incrementally.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+from time import time
+
+from sqlalchemy import create_engine, event, func, inspect, select
+from sqlalchemy.orm import sessionmaker
+
+from twisted.application import service
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+
+import configuration
+import database
+from indexes import create_indexes
+from database.models import (Player, Game, LeaderBoardEntry, UberAccount,
+                             Tournament, Patch)
+
+# rows are copied in chunks of this size
+CHUNK_SIZE = 1000
+
+GAME_KEY = inspect(Game).primary_key[0]
+GAME_PLAYERS = Game.players.property.secondary
+GAME_PLAYERS_GAME = [column for column in GAME_PLAYERS.columns
+                     if any(fk.references(Game.__table__)
+                            for fk in column.foreign_keys)][0]
+
+REPLICATED_TABLES = [Player.__table__, Game.__table__, GAME_PLAYERS,
+                     LeaderBoardEntry.__table__, UberAccount.__table__,
+                     Tournament.__table__, Patch.__table__]
+
+
+def create_replica_engine(path):
+    """Create an engine for the replica at path with tables and indexes."""
+    engine = create_engine("sqlite:///{0}".format(path),
+                           connect_args={"check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def tune(connection, record):
+        """Let readers and the sync thread work at the same time."""
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
+
+    Player.metadata.create_all(engine, tables=REPLICATED_TABLES)
+    create_indexes(engine)
+    return engine
+
+
+class ReplicaSync(service.Service):
+    """
+    Copies new and changed rows from the database into the replica.
+
+    Tables with an updated column are synchronized by timestamp, games and
+    their players by game key. All other tables are copied completely. Rows
+    deleted from the database remain in the replica until it's rebuilt. Every
+    sync runs in a worker thread.
+    """
+
+    def __init__(self, engine, interval=60):
+        """Remember the replica engine."""
+        self.engine = engine
+        self.interval = interval
+        self.syncing = False
+        self.poller = LoopingCall(self.poll)
+
+    def startService(self):
+        """Start synchronizing."""
+        service.Service.startService(self)
+        log.msg("Starting replica synchronization.")
+        self.poller.start(self.interval, True)
+
+    def stopService(self):
+        """Stop synchronizing."""
+        service.Service.stopService(self)
+        log.msg("Stopping replica synchronization.")
+        if self.poller.running:
+            self.poller.stop()
+
+    def poll(self):
+        """Start a sync unless one is still running."""
+        if self.syncing:
+            return
+
+        self.syncing = True
+        deferred = deferToThread(self.sync)
+        deferred.addCallback(self.onSynced)
+        deferred.addErrback(self.onError)
+        deferred.addBoth(self.done)
+
+    def sync(self):
+        """Copy all changes and return the number of rows copied per table."""
+        started = time()
+        source = database.Session()
+        copied = dict()
+        try:
+            with self.engine.begin() as replica:
+                for table in REPLICATED_TABLES:
+                    copied[table.name] = self.syncTable(source, replica,
+                                                        table)
+        finally:
+            source.close()
+        return copied, time() - started
+
+    def syncTable(self, source, replica, table):
+        """Copy the changes of a single table and return the row count."""
+        if table is Game.__table__ or table is GAME_PLAYERS:
+            # games are keyed by a monotonically increasing key
+            if table is Game.__table__:
+                column = GAME_KEY
+            else:
+                column = GAME_PLAYERS_GAME
+            last = replica.execute(select([func.max(column)])).scalar()
+            query = select([table])
+            if last is not None:
+                query = query.where(column > last)
+        elif "updated" in table.c:
+            # rows updated within the same second may have been missed
+            last = replica.execute(
+                select([func.max(table.c.updated)])).scalar()
+            query = select([table])
+            if last is not None:
+                query = query.where(table.c.updated >= last)
+        else:
+            replica.execute(table.delete())
+            query = select([table])
+
+        rows = source.execute(query)
+        insert = table.insert().prefix_with("OR REPLACE")
+        count = 0
+        while True:
+            chunk = [dict(row) for row in rows.fetchmany(CHUNK_SIZE)]
+            if not chunk:
+                return count
+            replica.execute(insert, chunk)
+            count += len(chunk)
+
+    def onSynced(self, result):
+        """Log what has been copied."""
+        copied, duration = result
+        log.msg(format="Synchronized %(rows)d rows into the replica in "
+                       "%(duration).3fs: %(tables)s",
+                rows=sum(copied.values()), duration=duration, tables=copied,
+                logKey="replica.sync")
+
+    def onError(self, error):
+        """Error callback for synchronizing, the next poll will retry."""
+        log.msg("Replica synchronization failed: {0}".format(
+            error.getErrorMessage()))
+
+    def done(self, _):
+        """Allow the next sync."""
+        self.syncing = False
+
+
+replica_cfg = configuration.get_config("replica")
+if replica_cfg["path"]:
+    engine = create_replica_engine(replica_cfg["path"])
+    Session = sessionmaker(bind=engine)
+else:
+    engine = None
+    Session = database.Session
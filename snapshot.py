@@ -0,0 +1,142 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+snapshot.py
+
+Persistence of warm caches across restarts.
+Parser caches and the bot's announcement state are written to a versioned,
+pickled snapshot file from time to time and restored on startup, before the
+bot connects.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+from cPickle import dump, load, HIGHEST_PROTOCOL, PicklingError
+from os import fchmod, fdopen, open as os_open, rename
+from os import O_CREAT, O_TRUNC, O_WRONLY
+from time import time
+
+from twisted.application import service
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+# increment whenever the layout of a snapshot or of any cached value changes
+SNAPSHOT_VERSION = 3
+
+
+class CacheSnapshot(service.Service):
+    """
+    Saves and restores the caches of a bot class.
+
+    Parsers take part by listing the names of their cached attributes in a
+    SNAPSHOT class attribute. Parsers that haven't been created yet are not
+    created for a snapshot: their restored state is handed to the LazyParser
+    and applied once the parser is created.
+    """
+
+    def __init__(self, path, factory, bot_class, interval=300):
+        """Remember where to store the caches of bot_class."""
+        self.path = path
+        self.factory = factory
+        self.bot_class = bot_class
+        self.interval = interval
+        self.saver = LoopingCall(self.save)
+
+    def startService(self):
+        """Start saving snapshots."""
+        service.Service.startService(self)
+        self.saver.start(self.interval, False)
+
+    def stopService(self):
+        """Stop saving snapshots and save a last one."""
+        service.Service.stopService(self)
+        if self.saver.running:
+            self.saver.stop()
+        self.save()
+
+    def parsers(self):
+        """Yield (name, LazyParser) tuples for all snapshot parsers."""
+        for name, attr in vars(self.bot_class).items():
+            parser_class = getattr(attr, "parser_class", None)
+            if getattr(parser_class, "SNAPSHOT", None):
+                yield name, attr
+
+    def collect(self):
+        """Return the current state of all caches."""
+        parsers = dict()
+        for name, lazy in self.parsers():
+            # recording proxies pass attributes through
+            parser = lazy.parser
+            if parser is None:
+                if lazy.state:
+                    parsers[name] = lazy.state
+                continue
+            parsers[name] = dict((attr, getattr(parser, attr))
+                                 for attr in lazy.parser_class.SNAPSHOT)
+
+        bot = self.factory.instance or self.bot_class
+        return {"version": SNAPSHOT_VERSION,
+                "created": time(),
+                "parsers": parsers,
+                "last_patches": bot.last_patches,
+                "towncrier": bot.towncrier.event}
+
+    def save(self):
+        """
+        Write a snapshot, replacing the previous one atomically.
+        Snapshots hold API credentials, so only the owner may read them.
+        """
+        started = time()
+        temporary = "{0}.tmp".format(self.path)
+        try:
+            descriptor = os_open(temporary, O_WRONLY | O_CREAT | O_TRUNC,
+                                 0600)
+            with fdopen(descriptor, "wb") as snapshot:
+                # the file may be left over from an older version
+                fchmod(snapshot.fileno(), 0600)
+                dump(self.collect(), snapshot, HIGHEST_PROTOCOL)
+            rename(temporary, self.path)
+        except (IOError, OSError, PicklingError, TypeError) as error:
+            log.msg("Cannot save snapshot: {0}".format(error))
+            return
+
+        log.msg(format="Saved snapshot in %(duration).3fs.",
+                duration=time() - started, logKey="snapshot.save")
+
+    def restore(self):
+        """
+        Restore caches from the last snapshot.
+        Missing, unreadable and outdated snapshots are ignored.
+        """
+        started = time()
+        try:
+            with open(self.path, "rb") as snapshot:
+                state = load(snapshot)
+        except IOError:
+            log.msg("No snapshot to restore.")
+            return
+        except Exception as error:
+            log.msg("Cannot read snapshot: {0}".format(error))
+            return
+
+        if state.get("version") != SNAPSHOT_VERSION:
+            log.msg("Ignoring snapshot of version {0}.".format(
+                state.get("version")))
+            return
+
+        for name, lazy in self.parsers():
+            parser_state = state["parsers"].get(name)
+            if not parser_state:
+                continue
+            lazy.state = parser_state
+            if lazy.parser is not None:
+                lazy.restore(lazy.parser)
+
+        self.bot_class.last_patches = state["last_patches"]
+        self.bot_class.towncrier.event = state["towncrier"]
+
+        log.msg(format="Restored snapshot from %(age).0fs ago in "
+                       "%(duration).3fs.",
+                age=time() - state["created"], duration=time() - started,
+                logKey="snapshot.restore")
@@ -0,0 +1,51 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+test_bot.py
+
+Tests for the Commander IRC bot's announcements.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+from datetime import datetime
+
+from twisted.trial import unittest
+
+from bot import CommanderBot
+from configuration import Config
+
+
+class RecordingBot(CommanderBot):
+    """Bot that records messages instead of sending them."""
+
+    def __init__(self):
+        """Initialize an empty message list."""
+        self.sent = list()
+
+    def msg(self, user, message, length=None):
+        """Record a message."""
+        self.sent.append((user, message))
+
+
+class PatchAnnouncementTests(unittest.TestCase):
+    """Tests for announcing new patches."""
+
+    patches = [{"build": "12345", "desc": u"Stable",
+                "date": datetime(2015, 6, 1, 12, 0)}]
+
+    def test_configured_channels(self):
+        """New patches are announced to every configured channel."""
+        bot = RecordingBot()
+        channels = Config({"channels": ["#a", "#b"]})["channels"]
+        bot.tell_patch(self.patches, channels, only_new=True)
+        self.assertEqual([channel for channel, _ in bot.sent], ["#a", "#b"])
+        self.assertIn(u"12345", bot.sent[0][1])
+
+    def test_only_new(self):
+        """Patches are announced only once."""
+        bot = RecordingBot()
+        bot.tell_patch(self.patches, ("#a", "#b"), only_new=True)
+        bot.tell_patch(self.patches, ("#a", "#b"), only_new=True)
+        self.assertEqual(len(bot.sent), 2)
@@ -0,0 +1,69 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+test_formatting.py
+
+Tests for IRC line splitting and packing.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+from twisted.trial import unittest
+
+from formatting import encoded_length, pack, split
+
+
+def characters(lines):
+    """Return all characters of lines except spaces."""
+    return u"".join(lines).replace(u" ", u"")
+
+
+class SplitTests(unittest.TestCase):
+    """Tests for split."""
+
+    TEXTS = [u"a bcde\x0304,05x",
+             u"a" * 20 + u"  " + u"b" * 30,
+             u"a b c d e",
+             u" abc def",
+             u"ab  cd   ef    gh",
+             u"x" * 5 + u" " + u"y" * 3,
+             u"caf\xe9 " * 10]
+
+    def test_limit(self):
+        """No line is longer than the limit."""
+        for text in self.TEXTS:
+            for limit in range(8, 25):
+                for line in split(text, limit):
+                    self.assertTrue(encoded_length(line) <= limit,
+                                    (text, limit, line))
+
+    def test_characters(self):
+        """Every character but spaces is kept, in order."""
+        for text in self.TEXTS:
+            for limit in range(8, 25):
+                self.assertEqual(characters(split(text, limit)),
+                                 characters([text]), (text, limit))
+
+    def test_spaces(self):
+        """Lines are broken at spaces."""
+        self.assertEqual(split(u"a b c d e", 3), [u"a b", u"c d", u"e"])
+        self.assertEqual(split(u"a" * 20 + u"  " + u"b" * 30, 20),
+                         [u"a" * 20, u"b" * 20, u"b" * 10])
+
+
+class PackTests(unittest.TestCase):
+    """Tests for pack."""
+
+    def test_characters(self):
+        """Items split over several lines keep all their characters."""
+        items = [u"x" * 15 + u"  " + u"y" * 30, u"z"]
+        lines = pack(items, 15)
+        self.assertTrue(all(encoded_length(line) <= 15 for line in lines))
+        self.assertEqual(characters(lines).replace(u",", u""),
+                         characters(items))
+
+    def test_header(self):
+        """Items share lines after the header."""
+        self.assertEqual(pack([u"alpha", u"beta", u"gamma"], 20, u"H: "),
+                         [u"H: alpha, beta", u"gamma"])
@@ -0,0 +1,37 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+test_ingest.py
+
+Tests for parsing ingested game results.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+from twisted.trial import unittest
+
+from ingest import parse_result
+from ladder import WDLCounters
+
+
+class ParseResultTests(unittest.TestCase):
+    """Tests for parse_result."""
+
+    def test_string_ids(self):
+        """Player and winner IDs sent as strings are counted correctly."""
+        result = parse_result({"key": "7", "winner": "1",
+                               "players": ["1", "2"]})
+        self.assertEqual((result["key"], result["winner"], result["players"]),
+                         (7, 1, [1, 2]))
+
+        wdl = WDLCounters()
+        wdl.last_key = 0
+        wdl.add_game(result["key"], result["winner"], result["players"])
+        self.assertEqual(wdl.get(1), (1, 0, 0))
+        self.assertEqual(wdl.get(2), (0, 0, 1))
+
+    def test_draw(self):
+        """A missing winner is a draw."""
+        result = parse_result({"key": 8, "winner": None, "players": [1, 2]})
+        self.assertIdentical(result["winner"], None)
@@ -1,11 +1,11 @@
 # vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
 
+from datetime import datetime
+
 from twisted.internet.defer import Deferred, succeed
 from twisted.python import log
 
-from sqlalchemy import func, extract
-
-from database import Session
+from replica import Session
 from database.models import Tournament
 
 
@@ -25,6 +25,11 @@ class TourneyParser(object):
         log.msg("Initializing Tourney parser.")
         self.session = Session()
 
+    def failed(self, failure, deferred):
+        """Roll back the session and fail deferred with failure."""
+        self.session.close()
+        deferred.errback(failure)
+
     def next(self):
         """Start an update and return a deferred containing the results."""
         updateDeferred = succeed(None)
@@ -32,11 +37,7 @@ class TourneyParser(object):
 
         def updateDone(value):
             """Callback method for update."""
-            query = self.session.query(Tournament)
-            query = query.filter(Tournament.winner.is_(None))
-            query = query.order_by(func.abs(extract(
-                "epoch", func.now() - Tournament.date)))
-            tournament = query.limit(1).first()
+            tournament = self.nearest(False)
             if not tournament:
                 newDeferred.callback(None)
             else:
@@ -47,6 +48,7 @@ class TourneyParser(object):
                 newDeferred.callback(tourney_dict)
             self.session.close()
         updateDeferred.addCallback(updateDone)
+        updateDeferred.addErrback(self.failed, newDeferred)
 
         return newDeferred
 
@@ -57,11 +59,7 @@ class TourneyParser(object):
 
         def updateDone(value):
             """Callback method for update."""
-            query = self.session.query(Tournament)
-            query = query.filter(Tournament.winner.isnot(None))
-            query = query.order_by(func.abs(extract(
-                "epoch", func.now() - Tournament.date)))
-            tournament = query.limit(1).first()
+            tournament = self.nearest(True)
             if not tournament:
                 newDeferred.callback(None)
             else:
@@ -73,5 +71,40 @@ class TourneyParser(object):
                 newDeferred.callback(tourney_dict)
             self.session.close()
         updateDeferred.addCallback(updateDone)
+        updateDeferred.addErrback(self.failed, newDeferred)
 
         return newDeferred
+
+    def nearest(self, finished):
+        """
+        Return the finished (or unfinished) tournament closest to now.
+        The closest ones before and after now are looked up separately, so
+        both lookups can use an index on the date.
+        """
+        now = datetime.utcnow()
+        candidates = [tournament for tournament in
+                      (self.nearestQuery(finished, now, False).first(),
+                       self.nearestQuery(finished, now, True).first())
+                      if tournament]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda t: abs(t.date - now))
+
+    def nearestQuery(self, finished, now, later):
+        """
+        Return the query for the finished (or unfinished) tournament closest
+        to now, either later or not later than now.
+        """
+        query = self.session.query(Tournament)
+        if finished:
+            query = query.filter(Tournament.winner.isnot(None))
+        else:
+            query = query.filter(Tournament.winner.is_(None))
+
+        if later:
+            query = query.filter(Tournament.date > now)
+            query = query.order_by(Tournament.date)
+        else:
+            query = query.filter(Tournament.date <= now)
+            query = query.order_by(Tournament.date.desc())
+        return query.limit(1)
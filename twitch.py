@@ -1,13 +1,28 @@
 # vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
 
 from binascii import crc32
+from collections import deque
 from json import loads
+from time import time
+from urllib import urlencode
 
-from twisted.internet.defer import Deferred
+from twisted.application import service
+from twisted.internet.defer import Deferred, DeferredSemaphore, gatherResults
+from twisted.internet.task import LoopingCall
 from twisted.python import log
 from twisted.web.client import getPage
 
+from breaker import CircuitBreaker
+from deadline import Deadline, http_timeout
+
 TWITCH_URL = "https://api.twitch.tv/kraken/streams?game=Planetary+Annihilation"
+# directory pages are requested concurrently, but only so many at once
+PAGE_SIZE = 100
+MAX_PAGES = 25
+CONCURRENCY = 4
+# aggregates are kept in buckets of ten minutes for a day
+HISTORY_BUCKET = 600
+HISTORY_LENGTH = 144
 
 
 class TwitchParser(object):
@@ -19,6 +34,9 @@ class TwitchParser(object):
     applications.
     """
 
+    # cached attributes kept in snapshots
+    SNAPSHOT = ("streams", "crc32", "viewers", "history")
+
     def __init__(self):
         """Initialize Twitch parser members."""
         log.msg("Initializing Twitch parser.")
@@ -26,51 +44,219 @@ class TwitchParser(object):
         # initialize our data members
         self.streams = tuple()
         self.crc32 = 0
+        self.viewers = 0
+        self.history = deque(maxlen=HISTORY_LENGTH)
+        self.breaker = CircuitBreaker("twitch")
+
+    def pageUrl(self, offset):
+        """Return the URL of the directory page starting at offset."""
+        separator = "&" if "?" in TWITCH_URL else "?"
+        return "{0}{1}{2}".format(TWITCH_URL, separator,
+                                  urlencode({"limit": PAGE_SIZE,
+                                             "offset": offset}))
 
-    def startUpdate(self):
+    def getPage(self, offset, deadline=None):
+        """Request the directory page starting at offset."""
+        return self.breaker.call(getPage, self.pageUrl(offset),
+                                 timeout=http_timeout(deadline))
+
+    def startUpdate(self, deadline=None):
         """
         Initiate an update using Twisted.
 
-        The request is handled asynchronously. It will call onUpdate if it's
-        successful and onError otherwise.
+        The first page tells how many streams there are, all other pages are
+        requested concurrently afterwards. It will call onUpdate with all
+        pages if it's successful and onError otherwise. All requests have to
+        finish before the optional deadline.
         """
-        log.msg("Updating URL contents for: {0}".format(TWITCH_URL))
-        deferred = getPage(TWITCH_URL)
+        log.msg(format="Updating URL contents for: %(url)s",
+                url=TWITCH_URL, logKey="twitch.request")
+        deferred = self.getPage(0, deadline)
+        deferred.addCallback(self.onFirstPage, deadline)
         deferred.addCallbacks(self.onUpdate, self.onError)
         return deferred
 
-    def onUpdate(self, value):
-        """Value callback for retrieving Twitch API data."""
+    def onFirstPage(self, value, deadline=None):
+        """Request all remaining pages and return a list of all pages."""
+        total = loads(value, encoding="utf-8").get("_total", 0)
+        offsets = range(PAGE_SIZE, min(total, PAGE_SIZE * MAX_PAGES),
+                        PAGE_SIZE)
+        if not offsets:
+            return [value]
+
+        semaphore = DeferredSemaphore(CONCURRENCY)
+        pages = gatherResults([semaphore.run(self.getPage, offset, deadline)
+                               for offset in offsets], consumeErrors=True)
+        pages.addCallback(lambda values: [value] + values)
+        return pages
+
+    def onUpdate(self, pages):
+        """Value callback for retrieving all Twitch API pages."""
         # compare checksum to avoid work
-        new_crc = crc32(value)
+        new_crc = 0
+        for value in pages:
+            new_crc = crc32(value, new_crc)
         if self.crc32 == new_crc:
-            log.msg("CRC32 hasn't changed, not parsing data.")
+            log.msg("CRC32 hasn't changed, not parsing data.",
+                    logKey="twitch.unchanged")
+            self.record()
             return self.streams
         self.crc32 = new_crc
 
-        data = loads(value, encoding="utf-8")
+        # streams may move between pages, keep the most viewed copy
+        unique = dict()
+        for value in pages:
+            data = loads(value, encoding="utf-8")
+            for stream in data["streams"]:
+                cid = stream["channel"]["_id"]
+                if (cid in unique and
+                        unique[cid]["viewers"] >= stream["viewers"]):
+                    continue
+                unique[cid] = {"id": cid,
+                               "name": stream["channel"]["display_name"],
+                               "desc": stream["channel"]["status"],
+                               "url": stream["channel"]["url"],
+                               "viewers": stream["viewers"]}
 
-        streams = tuple({"name": stream["channel"]["display_name"],
-                         "desc": stream["channel"]["status"],
-                         "url": stream["channel"]["url"],
-                         "viewers": stream["viewers"]}
-                        for stream in data["streams"])
-        self.streams = sorted(streams,
-                              key=lambda x: x["viewers"],
-                              reverse=True)
+        # unordered, only the most viewed streams are ever listed
+        self.streams = unique.values()
+        self.viewers = sum(stream["viewers"] for stream in self.streams)
+        self.record()
 
-        log.msg("Received and parsed new data: {0}".format(self.streams))
+        log.msg(format="Received and parsed %(count)d streams: %(streams)s",
+                count=len(self.streams), streams=self.streams,
+                logKey="twitch.update")
         return self.streams
 
+    def record(self):
+        """Add current aggregates to the history, keeping peaks per bucket."""
+        now = time()
+        bucket = int(now // HISTORY_BUCKET) * HISTORY_BUCKET
+        streams, viewers = len(self.streams), self.viewers
+        if self.history and self.history[-1][0] == bucket:
+            _, max_streams, max_viewers = self.history[-1]
+            self.history[-1] = (bucket, max(streams, max_streams),
+                                max(viewers, max_viewers))
+        else:
+            self.history.append((bucket, streams, viewers))
+
+    def statistics(self):
+        """
+        Return current and peak aggregates of the last day from memory.
+        The result is a dictionary with the current number of streams and
+        viewers and the peak buckets by viewers and by streams.
+        """
+        if not self.history:
+            return None
+
+        return {"streams": len(self.streams),
+                "viewers": self.viewers,
+                "peak_viewers": max(self.history, key=lambda x: x[2]),
+                "peak_streams": max(self.history, key=lambda x: x[1])}
+
     def onError(self, error):
         """Error callback for retrieving Twitch API data."""
         log.err("Encountered an error: {0}".format(
             error.getErrorMessage()))
         return error
 
-    def live(self):
+    def live(self, deadline=None):
         """Start an update and return a deferred containing the results."""
-        updateDeferred = self.startUpdate()
+        updateDeferred = self.startUpdate(deadline)
         newDeferred = Deferred()
         updateDeferred.addCallbacks(newDeferred.callback, newDeferred.errback)
         return newDeferred
+
+
+class StreamTracker(service.Service):
+    """
+    Tracks the Twitch directory and reports streams going live.
+
+    Snapshots are diffed by channel ID to find streams going live, going
+    offline and changing their title. Streams coming back within the
+    hold-down time after going offline are considered flapping and are not
+    reported again.
+    """
+
+    def __init__(self, getParser, announce, interval=120, holddown=900):
+        """
+        Initialize the tracker.
+        getParser returns the TwitchParser to use, announce is called with a
+        list of streams that went live.
+        """
+        self.getParser = getParser
+        self.announce = announce
+        self.interval = interval
+        self.holddown = holddown
+
+        self.known = None
+        self.offline = dict()
+        self.poller = LoopingCall(self.poll)
+
+    def startService(self):
+        """Start polling."""
+        service.Service.startService(self)
+        log.msg("Starting Twitch stream tracker.")
+        self.poller.start(self.interval, True)
+
+    def stopService(self):
+        """Stop polling."""
+        service.Service.stopService(self)
+        log.msg("Stopping Twitch stream tracker.")
+        if self.poller.running:
+            self.poller.stop()
+
+    def poll(self):
+        """Fetch the current directory, giving up before the next poll."""
+        deferred = self.getParser().live(Deadline(self.interval))
+        deferred.addCallbacks(self.onStreams, self.onError)
+
+    @staticmethod
+    def diff(previous, current):
+        """
+        Compare two snapshots mapping channel IDs to streams.
+        Return lists of streams that went live, went offline and changed
+        their title.
+        """
+        live = [stream for cid, stream in current.iteritems()
+                if cid not in previous]
+        offline = [stream for cid, stream in previous.iteritems()
+                   if cid not in current]
+        changed = [stream for cid, stream in current.iteritems()
+                   if cid in previous and
+                   stream["desc"] != previous[cid]["desc"]]
+        return live, offline, changed
+
+    def onStreams(self, streams):
+        """Diff a new snapshot against the last one and announce."""
+        current = dict((stream["id"], stream) for stream in streams)
+        # the first snapshot only serves as baseline
+        if self.known is None:
+            self.known = current
+            return
+
+        live, offline, changed = self.diff(self.known, current)
+        self.known = current
+
+        now = time()
+        for stream in offline:
+            self.offline[stream["id"]] = now
+        for cid, since in self.offline.items():
+            if now - since > self.holddown:
+                del self.offline[cid]
+        fresh = [stream for stream in live
+                 if self.offline.pop(stream["id"], None) is None]
+
+        if live or offline or changed:
+            log.msg(format="Streams changed: %(live)d live (%(fresh)d new), "
+                           "%(offline)d offline, %(changed)d new titles.",
+                    live=len(live), fresh=len(fresh), offline=len(offline),
+                    changed=len(changed), logKey="twitch.tracker")
+        if fresh:
+            self.announce(sorted(fresh, key=lambda x: x["viewers"],
+                                 reverse=True))
+
+    def onError(self, error):
+        """Error callback for polling, the next poll will retry."""
+        log.msg("Stream tracker update failed: {0}".format(
+            error.getErrorMessage()))
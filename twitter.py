@@ -1,22 +1,34 @@
 # vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
 
+import re
+
 from base64 import b64encode
 from binascii import crc32
+from collections import OrderedDict, deque
 from datetime import datetime
 from json import loads
 from urllib import urlencode, quote
 from HTMLParser import HTMLParser
 
+from twisted.application import service
 from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import LoopingCall
 from twisted.python import log
 from twisted.web.client import getPage
 
+from breaker import CircuitBreaker
+from deadline import Deadline, http_timeout
+
 import configuration
 
 CREATED_AT_FORMAT = "%a %b %d %H:%M:%S +0000 %Y"
 TWITTER_SEARCH_URL = "https://api.twitter.com/1.1/search/tweets.json"
 TWITTER_OAUTH2_URL = "https://api.twitter.com/oauth2/token"
 
+# everything that differs between copies of the same text
+NORMALIZE_NOISE = re.compile(r"^rt @\w+:|https?://\S+|@\w+|[^\w#@]+",
+                             re.UNICODE)
+
 
 class TwitterParser(object):
     """
@@ -26,12 +38,24 @@ class TwitterParser(object):
     applications.
     """
 
+    # cached attributes kept in snapshots
+    SNAPSHOT = ("tweets", "crc32", "bearer")
+
     def __init__(self):
-        """Read configuration from a file or store defaults."""
+        """Read configuration and follow changes to it."""
         log.msg("Initializing Twitter parser.")
 
-        twitter_cfg = configuration.get_config("twitter")
+        # initialize our data members
+        self.bearer = None
+        self.tweets = tuple()
+        self.crc32 = 0
+        self.breaker = CircuitBreaker("twitter")
+
+        self.configure(configuration.get_config("twitter"))
+        configuration.add_observer(self.reconfigure)
 
+    def configure(self, twitter_cfg):
+        """Build the credentials and search URL from the configuration."""
         self.b64token = b64encode("{0}:{1}".format(
             quote(twitter_cfg["key"]), quote(twitter_cfg["secret"])))
 
@@ -43,12 +67,18 @@ class TwitterParser(object):
         self.url = "{0}?{1}".format(TWITTER_SEARCH_URL, urlencode(params))
         log.msg("Encoded Twitter API URL: {0}".format(self.url))
 
-        # initialize our data members
-        self.bearer = None
-        self.tweets = tuple()
-        self.crc32 = 0
+    def reconfigure(self, changes):
+        """Apply a changed configuration, cached Tweets are kept."""
+        if "twitter" not in changes:
+            return
+
+        old, new = changes["twitter"]
+        self.configure(new)
+        # a bearer token is only valid for the credentials it was issued to
+        if (old["key"], old["secret"]) != (new["key"], new["secret"]):
+            self.bearer = None
 
-    def getBearer(self):
+    def getBearer(self, deadline=None):
         """Get the bearer token used to authenticate for the API call."""
         # if we already have the bearer token we return success right away
         if self.bearer:
@@ -60,10 +90,11 @@ class TwitterParser(object):
                    "Content-Type": "application/x-www-form-urlencoded;"
                                    "charset=UTF-8"}
 
-        deferred = getPage(TWITTER_OAUTH2_URL,
-                           method="POST",
-                           postdata="grant_type=client_credentials",
-                           headers=headers)
+        deferred = self.breaker.call(getPage, TWITTER_OAUTH2_URL,
+                                     method="POST",
+                                     postdata="grant_type=client_credentials",
+                                     headers=headers,
+                                     timeout=http_timeout(deadline))
         deferred.addCallbacks(self.onBearer, self.onError)
         return deferred
 
@@ -74,15 +105,18 @@ class TwitterParser(object):
         self.bearer = data.get("access_token")
         return True if "access_token" in data else False
 
-    def startUpdate(self):
+    def startUpdate(self, since=None, deadline=None):
         """
         Initiate an update using Twisted.
 
         The request is handled asynchronously. It will call onUpdate if it's
-        successful and onError otherwise.
+        successful and onError otherwise. If since is given, only Tweets
+        newer than that ID are requested and returned without replacing the
+        cached Tweets. All requests have to finish before the optional
+        deadline.
         """
         # get bearer either from cache or with a new request
-        bearerDeferred = self.getBearer()
+        bearerDeferred = self.getBearer(deadline)
 
         def gotBearer(success):
             """Local callback for bearer token."""
@@ -90,36 +124,52 @@ class TwitterParser(object):
             if not success or not self.bearer:
                 return fail()
             # otherwise we start the update here
-            log.msg("Updating URL contents for: {0}".format(self.url))
+            url = self.url
+            if since is not None:
+                url = "{0}&{1}".format(url, urlencode({"since_id": since}))
+            log.msg(format="Updating URL contents for: %(url)s",
+                    url=url, logKey="twitter.request")
             headers = {"Authorization": "Bearer {0}".format(self.bearer)}
-            deferred = getPage(self.url, headers=headers)
-            deferred.addCallbacks(self.onUpdate, self.onError)
+            deferred = self.breaker.call(getPage, url, headers=headers,
+                                         timeout=http_timeout(deadline))
+            if since is None:
+                deferred.addCallbacks(self.onUpdate, self.onError)
+            else:
+                deferred.addCallbacks(self.parse, self.onError)
             return deferred
 
         # now chain the callbacks together
         bearerDeferred.addCallback(gotBearer)
         return bearerDeferred
 
+    def parse(self, value):
+        """Return a tuple of Tweets parsed from an API response."""
+        data = loads(value, encoding="utf-8")
+        parser = HTMLParser()
+        return tuple({"id": status["id"],
+                      "date": datetime.strptime(status["created_at"],
+                                                CREATED_AT_FORMAT),
+                      "text": parser.unescape(status["text"]),
+                      "name": status["user"]["name"],
+                      "screen": status["user"]["screen_name"]}
+                     for status in data["statuses"]
+                     if "retweeted_status" not in status and
+                     not status["text"].startswith("RT"))
+
     def onUpdate(self, value):
         """Value callback for retrieving Twitter API data."""
         # compare checksum to avoid work
         new_crc = crc32(value)
         if self.crc32 == new_crc:
-            log.msg("CRC32 hasn't changed, not parsing data.")
+            log.msg("CRC32 hasn't changed, not parsing data.",
+                    logKey="twitter.unchanged")
             return self.tweets
         self.crc32 = new_crc
 
-        data = loads(value, encoding="utf-8")
-        parser = HTMLParser()
-        self.tweets = tuple({"date": datetime.strptime(status["created_at"],
-                                                       CREATED_AT_FORMAT),
-                             "text": parser.unescape(status["text"]),
-                             "name": status["user"]["name"],
-                             "screen": status["user"]["screen_name"]}
-                            for status in data["statuses"]
-                            if not status["text"].startswith("RT"))
-
-        log.msg("Received and parsed new data.")
+        self.tweets = self.parse(value)
+
+        log.msg(format="Received and parsed %(count)d tweets.",
+                count=len(self.tweets), logKey="twitter.update")
         return self.tweets
 
     def onError(self, error):
@@ -128,14 +178,105 @@ class TwitterParser(object):
             error.getErrorMessage()))
         return error
 
-    def latest(self, n):
+    def latest(self, n, deadline=None):
         """Start an update and return a deferred containing the results."""
-        updateDeferred = self.startUpdate()
+        updateDeferred = self.startUpdate(deadline=deadline)
         newDeferred = Deferred()
 
         def updateDone(value):
             """Callback method for update."""
             newDeferred.callback(self.tweets[0:n])
-        updateDeferred.addCallback(updateDone)
+        updateDeferred.addCallbacks(updateDone, newDeferred.errback)
 
         return newDeferred
+
+
+def normalize(text):
+    """Return the text of a Tweet without links, mentions and punctuation."""
+    return u" ".join(NORMALIZE_NOISE.sub(u" ", text.lower()).split())
+
+
+class SeenSet(object):
+    """Bounded set forgetting the least recently seen keys first."""
+
+    def __init__(self, maxsize=10000):
+        """Initialize an empty set."""
+        self.maxsize = maxsize
+        self.keys = OrderedDict()
+
+    def add(self, key):
+        """Add key and return True if it was seen before."""
+        seen = self.keys.pop(key, False)
+        self.keys[key] = True
+        if len(self.keys) > self.maxsize:
+            self.keys.popitem(last=False)
+        return seen
+
+
+class TweetWatcher(service.Service):
+    """
+    Polls for new Tweets and announces them.
+
+    Only Tweets newer than the newest one seen are requested. Tweets are
+    de-duplicated by ID and by normalized text, so reposted copies are
+    dropped. New Tweets are queued and announced in batches of limited size
+    at most once per interval.
+    """
+
+    def __init__(self, getParser, announce, interval=300, batch=3,
+                 backlog=30):
+        """
+        Initialize the watcher.
+        getParser returns the TwitterParser to use, announce is called with a
+        list of Tweets.
+        """
+        self.getParser = getParser
+        self.announce = announce
+        self.interval = interval
+        self.batch = batch
+
+        self.since = None
+        self.seen = SeenSet()
+        self.pending = deque(maxlen=backlog)
+        self.poller = LoopingCall(self.poll)
+
+    def startService(self):
+        """Start polling."""
+        service.Service.startService(self)
+        log.msg("Starting Tweet watcher.")
+        self.poller.start(self.interval, True)
+
+    def stopService(self):
+        """Stop polling."""
+        service.Service.stopService(self)
+        log.msg("Stopping Tweet watcher.")
+        if self.poller.running:
+            self.poller.stop()
+
+    def poll(self):
+        """Announce a batch of queued Tweets and request new ones."""
+        if self.pending:
+            batch = [self.pending.popleft()
+                     for _ in range(min(self.batch, len(self.pending)))]
+            self.announce(batch)
+
+        # give up before the next poll
+        deferred = self.getParser().startUpdate(self.since or 1,
+                                                Deadline(self.interval))
+        deferred.addCallbacks(self.onTweets, self.onError)
+
+    def onTweets(self, tweets):
+        """Queue Tweets that haven't been seen yet, oldest first."""
+        baseline = self.since is None
+        for tweet in sorted(tweets, key=lambda t: t["id"]):
+            self.since = max(self.since, tweet["id"])
+            duplicate = self.seen.add(("text", normalize(tweet["text"])))
+            duplicate = self.seen.add(("id", tweet["id"])) or duplicate
+            # the first response only serves as baseline
+            if not duplicate and not baseline:
+                self.pending.append(tweet)
+
+    def onError(self, error):
+        """Error callback for polling, the next poll will retry."""
+        log.msg("Tweet watcher update failed: {0}".format(
+            error.getErrorMessage()))
@@ -0,0 +1,129 @@
+# vim:fileencoding=utf-8:ts=8:et:sw=4:sts=4:tw=79
+
+"""
+watchdog.py
+
+Reactor lag monitor and slow callback watchdog.
+It measures how late the reactor runs a periodic timer and logs a stack
+sample of the reactor thread whenever a callback blocks it for too long.
+
+Copyright (c) 2015 Pyrus <pyrus at coffee dash break dot at>
+See the file LICENSE for copying permission.
+"""
+
+import sys
+
+from collections import deque
+from thread import get_ident
+from threading import Event, Thread
+from time import time
+from traceback import format_stack
+
+from twisted.application import service
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+
+class ReactorWatchdog(service.Service):
+    """
+    Service measuring reactor lag.
+
+    A timer in the reactor records a heartbeat and its delay. A separate
+    thread checks the heartbeat and samples the reactor thread's stack if it
+    is older than the threshold, i.e. a callback is blocking the reactor.
+    """
+
+    def __init__(self, threshold=0.5, shed=None, interval=0.1,
+                 samples=3000, report=600):
+        """
+        Initialize the watchdog.
+        threshold is the blocking time in seconds that triggers a stack
+        sample, shed the recent lag above which overloaded is reported.
+        """
+        self.threshold = threshold
+        self.shed = shed
+        self.interval = interval
+        self.report = report
+
+        self.lags = deque(maxlen=samples)
+        self.heartbeat = None
+        self.reactor_thread = None
+        self.stalls = 0
+        self.stopping = Event()
+
+        self.ticker = LoopingCall(self.tick)
+        self.reporter = LoopingCall(self.log_percentiles)
+
+    def startService(self):
+        """Start measuring lag and watching the reactor thread."""
+        service.Service.startService(self)
+        log.msg("Starting reactor watchdog.")
+        self.reactor_thread = get_ident()
+        self.heartbeat = time()
+        self.stopping.clear()
+        self.ticker.start(self.interval, False)
+        self.reporter.start(self.report, False)
+
+        watcher = Thread(target=self.watch, name="ReactorWatchdog")
+        watcher.daemon = True
+        watcher.start()
+
+    def stopService(self):
+        """Stop measuring and watching."""
+        service.Service.stopService(self)
+        log.msg("Stopping reactor watchdog.")
+        self.stopping.set()
+        for loop in (self.ticker, self.reporter):
+            if loop.running:
+                loop.stop()
+
+    def tick(self):
+        """Record the delay of this timer call."""
+        now = time()
+        self.lags.append(max(0.0, now - self.heartbeat - self.interval))
+        self.heartbeat = now
+
+    def watch(self):
+        """Sample the reactor thread's stack whenever it is blocked."""
+        reported = None
+        while not self.stopping.wait(self.threshold / 2):
+            heartbeat = self.heartbeat
+            blocked = time() - heartbeat - self.interval
+            if blocked < self.threshold or heartbeat == reported:
+                continue
+
+            # only sample every stall once
+            reported = heartbeat
+            self.stalls += 1
+            frame = sys._current_frames().get(self.reactor_thread)
+            stack = "".join(format_stack(frame)) if frame else "unknown"
+            log.msg("Reactor blocked for {0:.3f}s in:\n{1}".format(
+                blocked, stack))
+
+    def percentiles(self, fractions=(0.5, 0.9, 0.99)):
+        """Return a dictionary of lag percentiles in seconds."""
+        lags = sorted(self.lags)
+        if not lags:
+            return dict((fraction, 0.0) for fraction in fractions)
+        return dict((fraction, lags[int(round(fraction * (len(lags) - 1)))])
+                    for fraction in fractions)
+
+    @property
+    def overloaded(self):
+        """
+        Return True if non-interactive work should be dropped.
+        That is the case if the p90 lag of the last 50 samples exceeds shed.
+        """
+        if not self.shed:
+            return False
+        recent = sorted(list(self.lags)[-50:])
+        if not recent:
+            return False
+        return recent[int(0.9 * (len(recent) - 1))] > self.shed
+
+    def log_percentiles(self):
+        """Log current lag percentiles."""
+        lags = self.percentiles()
+        log.msg("Reactor lag p50 {0:.1f}ms, p90 {1:.1f}ms, p99 {2:.1f}ms, "
+                "{3} stalls.".format(1000 * lags[0.5], 1000 * lags[0.9],
+                                     1000 * lags[0.99], self.stalls))